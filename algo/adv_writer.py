@@ -0,0 +1,104 @@
+import glob
+import json
+import os
+import queue
+import threading
+import numpy as np
+
+# fields written for every adversarial injection record
+ADV_FIELDS = ["ego_states", "goal", "ego_hist_traj", "ego_hist_traj_diff", "ego_fut_traj"]
+
+
+def build_adv_records(columns, noise, num_noise=2, fut_steps=slice(1, 7), fut_value=-100.0):
+    """
+    Builds the perturbed records of all samples at once from the packed (N, ...) columns: the noise is
+    added to the last `num_noise` ego states and the y coordinate of the `fut_steps` future waypoints
+    is overwritten with `fut_value`.
+    """
+    records = {field: np.array(columns[field], copy=True) for field in ADV_FIELDS}
+    records["ego_states"][:, -num_noise:] += np.asarray(noise, dtype=records["ego_states"].dtype)
+    records["ego_fut_traj"][:, fut_steps, 1] = fut_value
+    return records
+
+
+class AsyncShardWriter:
+    """
+    Appends one npz shard per `submit` to `out_dir` from a background thread, so that saving never
+    blocks the optimization loop. Shards are never rewritten; `export_legacy_json` merges them on demand.
+    A failed write stops the thread and is re-raised by the next `submit` or by `close`.
+    """
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            iteration, tokens, records = job
+            path = f"{self.out_dir}/shard_{iteration:06d}.npz"
+            tmp_path = f"{self.out_dir}/.shard_{iteration:06d}.tmp.npz"
+            try:
+                np.savez(tmp_path, token=np.asarray(tokens), iteration=iteration, **records)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self._error = e
+                break
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"Writing adversarial shards to {self.out_dir} failed") from self._error
+
+    def submit(self, iteration, tokens, records):
+        self._raise_error()
+        self._queue.put((iteration, list(tokens), records))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+
+def load_shard_records(shard_dir):
+    """
+    Merges the shards of `shard_dir` in iteration order; later shards overwrite earlier records of the same token.
+    """
+    records = {}
+    for path in sorted(glob.glob(f"{shard_dir}/shard_*.npz")):
+        with np.load(path) as shard:
+            fields = {field: shard[field] for field in ADV_FIELDS}
+            for row, token in enumerate(shard["token"]):
+                records[str(token)] = {field: fields[field][row] for field in ADV_FIELDS}
+    return records
+
+
+def export_legacy_json(shard_dir, out_path):
+    """
+    Writes the merged shard records as the legacy `{token: {field: nested lists}}` JSON file.
+    """
+    records = load_shard_records(shard_dir)
+    legacy = {}
+    for token, record in records.items():
+        legacy[token] = {field: record[field].tolist() for field in ADV_FIELDS}
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(legacy, f, indent=4)
+    return out_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard_dir", type=str, required=True, help="Directory of the npz shards of one run")
+    parser.add_argument("--out", type=str, default="RAG/hotflip/adv_injection/all_2000.json", help="Legacy JSON output file")
+    args = parser.parse_args()
+
+    export_legacy_json(args.shard_dir, args.out)
+    print(f"Exported {args.shard_dir} to {args.out}")
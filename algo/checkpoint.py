@@ -0,0 +1,58 @@
+import os
+import glob
+import random
+import torch
+
+CHECKPOINT_NAME = "checkpoint.pt"
+
+
+def get_rng_state(shuffle_generator=None):
+    """
+    Collects the Python, torch (CPU and CUDA) and DataLoader shuffle RNG states.
+    """
+    rng_state = {
+        "python": random.getstate(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "shuffle": shuffle_generator.get_state() if shuffle_generator is not None else None,
+    }
+    return rng_state
+
+
+def set_rng_state(rng_state, shuffle_generator=None):
+    random.setstate(rng_state["python"])
+    torch.set_rng_state(rng_state["torch"])
+    if rng_state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+    if shuffle_generator is not None and rng_state["shuffle"] is not None:
+        shuffle_generator.set_state(rng_state["shuffle"])
+
+
+def save_checkpoint(root_dir, checkpoint):
+    """
+    Writes the checkpoint to `root_dir` atomically, so a crash while saving keeps the previous one.
+    """
+    path = f"{root_dir}/{CHECKPOINT_NAME}"
+    tmp_path = f"{path}.tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def find_latest_checkpoint(search_dir):
+    """
+    Returns the most recently written checkpoint under `search_dir` (a run directory or a parent of run directories).
+    """
+    if os.path.isfile(search_dir):
+        return search_dir
+    if os.path.isfile(f"{search_dir}/{CHECKPOINT_NAME}"):
+        return f"{search_dir}/{CHECKPOINT_NAME}"
+    candidates = glob.glob(f"{search_dir}/*/{CHECKPOINT_NAME}")
+    if len(candidates) == 0:
+        raise FileNotFoundError(f"No checkpoint found under {search_dir}")
+    return max(candidates, key=os.path.getmtime)
+
+
+def load_checkpoint(path):
+    # the checkpoint holds RNG states and python objects besides tensors
+    return torch.load(path, map_location="cpu", weights_only=False)
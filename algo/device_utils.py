@@ -0,0 +1,94 @@
+import contextlib
+import os
+import torch
+import torch.multiprocessing as torch_mp
+
+# [query; trigger] sequences per retriever forward: small CPU batches keep the activations cache-resident
+# and waste less compute on padding, large GPU batches keep the device busy
+FORWARD_BATCH_SIZE = {"cpu": 8, "cuda": 64}
+
+
+def resolve_device(device="auto"):
+    """
+    Maps "auto" (or None) to the first GPU if there is one and to the CPU otherwise.
+    """
+    if device is None or device == "auto":
+        return "cuda:0" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+def device_type(device):
+    return torch.device(device).type
+
+
+def model_device(model):
+    return next(model.parameters()).device
+
+
+def default_forward_batch_size(device):
+    return FORWARD_BATCH_SIZE.get(device_type(device), FORWARD_BATCH_SIZE["cuda"])
+
+
+def available_cpus():
+    """
+    CPUs this process may run on (affinity / cgroup cpuset), falling back to `os.cpu_count()` where
+    affinity is not available.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_cpu_threads(num_workers=1, num_threads=None, num_interop_threads=None):
+    """
+    Splits the cores between `num_workers` processes: every worker gets `num_threads` intra-op threads
+    (by default its share of the available CPUs) and `num_interop_threads` inter-op threads. A single
+    process without `num_threads` keeps torch's own default.
+    """
+    if num_threads is None and num_workers > 1:
+        num_threads = max(1, available_cpus() // num_workers)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            # can only be set before the first inter-op parallel work of the process
+            print(e)
+    return num_threads if num_threads is not None else torch.get_num_threads()
+
+
+def worker_context(resources):
+    """
+    Multiprocessing context and resources for worker processes that share one loaded retriever. CPU
+    workers are forked over the model in shared memory. CUDA state cannot be forked, so GPU workers are
+    spawned and receive the CUDA tensors through IPC handles; exported engines cannot be pickled for
+    them, so they score in eager mode.
+    """
+    resources = dict(resources)
+    if device_type(resources["device"]) == "cpu":
+        resources["model"].share_memory()
+        return torch_mp.get_context("fork"), resources
+    resources.pop("scoring_model", None)
+    return torch_mp.get_context("spawn"), resources
+
+
+def worker_resources(resources):
+    """
+    Copy of `resources` inside a worker process, with the embedding module re-resolved so that the
+    gradient hook sits on the model this worker runs.
+    """
+    # algo.utils imports this module
+    from algo.utils import get_embeddings
+    resources = dict(resources)
+    resources["embeddings"] = get_embeddings(resources["model"])
+    return resources
+
+
+def scoring_autocast(device, bf16=False):
+    """
+    bfloat16 autocast for forward-only scoring on CPU or GPU; a no-op unless `bf16` is set.
+    """
+    if not bf16:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type(device), dtype=torch.bfloat16)
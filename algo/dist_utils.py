@@ -0,0 +1,40 @@
+import os
+import socket
+import torch
+import torch.distributed as dist
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def all_reduce_sum(tensor):
+    """
+    Sums `tensor` in place over all data-parallel workers; a no-op in a single process.
+    """
+    if get_world_size() > 1:
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def shard_indices(num_items, device=None):
+    """
+    Returns the indices of `num_items` this worker is responsible for (round-robin over the workers).
+    """
+    return torch.arange(get_rank(), num_items, get_world_size(), device=device)
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def init_gloo(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
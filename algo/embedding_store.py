@@ -0,0 +1,314 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from pathlib import Path
+
+# storage of the cached memory embeddings; "float32" keeps the plain dense tensor
+MEMORY_STORAGE = ["float32", "float16", "int8", "pq"]
+
+
+def _kmeans(x, num_clusters, num_iters=20, seed=0, chunk_size=65536):
+    """
+    Lloyd k-means on the rows of `x`; returns the (K, d) centroids. Empty clusters are re-seeded from random rows.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_clusters = min(num_clusters, len(x))
+    centroids = x[torch.randperm(len(x), generator=generator)[:num_clusters]].clone()
+    for _ in range(num_iters):
+        assignment = torch.cat([torch.cdist(chunk, centroids).argmin(dim=1) for chunk in x.split(chunk_size)])
+        counts = torch.bincount(assignment, minlength=num_clusters)
+        centroids = torch.zeros_like(centroids).index_add_(0, assignment, x) / counts.clamp(min=1).unsqueeze(1)
+        empty = counts == 0
+        if empty.any():
+            centroids[empty] = x[torch.randint(len(x), (int(empty.sum()),), generator=generator)]
+    return centroids
+
+
+class CompressedEmbeddings:
+    """
+    Memory embeddings stored as float16, 8-bit per-dimension codes or product-quantized (PQ) codes.
+    Distances and inner products to float32 queries are computed asymmetrically (ADC): the queries stay
+    exact, only the memory side is approximated, and the codes are scored chunk by chunk without ever
+    decoding the whole matrix. Everything is differentiable with respect to the queries.
+    """
+    def __init__(self, mode, dim, codes, norms=None, scale=None, offset=None, codebooks=None, report=None):
+        self.mode = mode
+        self.dim = dim
+        self.codes = codes
+        self.norms = norms
+        self.scale = scale
+        self.offset = offset
+        self.codebooks = codebooks
+        self.report = report or {}
+        self._self_kernel = {}
+
+    @classmethod
+    def encode(cls, embeddings, mode, num_subspaces=None, num_centroids=256, train_points=50000, chunk_size=65536, seed=0):
+        """
+        Compresses (N, D) float embeddings. PQ splits D into `num_subspaces` sub-vectors (by default one
+        per 8 dimensions, zero-padded) with a `num_centroids` k-means codebook each, trained on at most
+        `train_points` rows; every row is then stored as one byte per subspace.
+        """
+        embeddings = embeddings.detach().float().cpu()
+        num_rows, dim = embeddings.shape
+        if mode == "float16":
+            store = cls(mode, dim, embeddings.half())
+        elif mode == "int8":
+            low, high = embeddings.min(dim=0).values, embeddings.max(dim=0).values
+            scale = ((high - low) / 255).clamp(min=1e-12)
+            codes = torch.cat([((chunk - low) / scale).round().clamp(0, 255).to(torch.uint8) for chunk in embeddings.split(chunk_size)])
+            store = cls(mode, dim, codes, scale=scale, offset=low)
+        elif mode == "pq":
+            if num_centroids > 256:
+                raise ValueError(f"PQ codes are stored as bytes, num_centroids must be <= 256, got {num_centroids}")
+            num_subspaces = num_subspaces or -(-dim // 8)
+            sub_dim = -(-dim // num_subspaces)
+            padded = F.pad(embeddings, (0, num_subspaces * sub_dim - dim)).view(num_rows, num_subspaces, sub_dim)
+            train_rows = torch.randperm(num_rows, generator=torch.Generator().manual_seed(seed))[:train_points]
+            codebooks = torch.stack([_kmeans(padded[train_rows, m], num_centroids, seed=seed + m) for m in range(num_subspaces)])
+            codes = torch.empty(num_rows, num_subspaces, dtype=torch.uint8)
+            for start in range(0, num_rows, chunk_size):
+                chunk = padded[start:start + chunk_size].transpose(0, 1)
+                codes[start:start + chunk_size] = torch.cdist(chunk, codebooks).argmin(dim=2).T.to(torch.uint8)
+            store = cls(mode, dim, codes, codebooks=codebooks)
+        else:
+            raise ValueError(f"Unknown memory storage {mode}, choose from {MEMORY_STORAGE}")
+
+        # squared norms of the decoded rows turn inner products into squared distances
+        store.norms = torch.cat([store.decode(rows).pow(2).sum(dim=1) for rows in store._chunks(chunk_size)])
+        return store
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return (len(self), self.dim)
+
+    @property
+    def nbytes(self):
+        tensors = [self.codes, self.norms, self.scale, self.offset, self.codebooks]
+        return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+    def _chunks(self, chunk_size):
+        for start in range(0, len(self), chunk_size):
+            yield slice(start, start + chunk_size)
+
+    def to(self, device):
+        for name in ["codes", "norms", "scale", "offset", "codebooks"]:
+            if getattr(self, name) is not None:
+                setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    def share_memory(self):
+        for t in [self.codes, self.norms, self.scale, self.offset, self.codebooks]:
+            if t is not None:
+                t.share_memory_()
+        return self
+
+    def subset(self, rows):
+        return CompressedEmbeddings(self.mode, self.dim, self.codes[rows], self.norms[rows], self.scale, self.offset, self.codebooks)
+
+    def decode(self, rows=None):
+        """
+        float32 reconstruction of `rows` (all rows by default).
+        """
+        codes = self.codes if rows is None else self.codes[rows]
+        if self.mode == "float16":
+            return codes.float()
+        if self.mode == "int8":
+            return codes.float() * self.scale + self.offset
+        num_subspaces = self.codebooks.shape[0]
+        subspaces = torch.arange(num_subspaces, device=codes.device)
+        return self.codebooks[subspaces, codes.long()].reshape(len(codes), -1)[:, :self.dim]
+
+    def sample(self, max_points, seed=0):
+        """
+        Decoded float32 rows, subsampled to `max_points` with the same draw `dense_sample` uses for dense tensors.
+        """
+        if len(self) <= max_points:
+            return self.decode()
+        rng = np.random.default_rng(seed)
+        sample_idx = np.sort(rng.choice(len(self), max_points, replace=False))
+        return self.decode(torch.from_numpy(sample_idx).to(self.codes.device))
+
+    def _query_tables(self, queries):
+        if self.mode == "int8":
+            return queries * self.scale.to(queries.device), queries @ self.offset.to(queries.device)
+        if self.mode == "pq":
+            num_subspaces, _, sub_dim = self.codebooks.shape
+            padded = F.pad(queries, (0, num_subspaces * sub_dim - self.dim)).view(len(queries), num_subspaces, sub_dim)
+            # (Q, M, K) inner products of every query sub-vector with every centroid
+            return torch.einsum("qms,mks->qmk", padded, self.codebooks.to(queries.device)),
+        return queries,
+
+    def _inner_products_chunk(self, tables, rows, device):
+        codes = self.codes[rows].to(device)
+        if self.mode == "float16":
+            return tables[0] @ codes.float().T
+        if self.mode == "int8":
+            scaled_queries, offset_products = tables
+            return scaled_queries @ codes.float().T + offset_products.unsqueeze(1)
+        lut = tables[0]
+        codes = codes.long()
+        products = lut[:, 0, codes[:, 0]]
+        for m in range(1, codes.shape[1]):
+            products = products + lut[:, m, codes[:, m]]
+        return products
+
+    def inner_products(self, queries, chunk_size=16384):
+        """
+        (Q, N) inner products of float32 `queries` with the memory.
+        """
+        queries = queries.float()
+        tables = self._query_tables(queries)
+        return torch.cat([self._inner_products_chunk(tables, rows, queries.device) for rows in self._chunks(chunk_size)], dim=1)
+
+    def _squared_distances_chunks(self, queries, chunk_size):
+        queries = queries.float()
+        tables = self._query_tables(queries)
+        query_norms = queries.pow(2).sum(dim=1, keepdim=True)
+        for rows in self._chunks(chunk_size):
+            products = self._inner_products_chunk(tables, rows, queries.device)
+            yield rows, (query_norms - 2 * products + self.norms[rows].to(queries.device)).clamp(min=0)
+
+    def squared_distances(self, queries, chunk_size=16384):
+        """
+        (Q, N) squared Euclidean distances of float32 `queries` to the memory.
+        """
+        return torch.cat([distances for _, distances in self._squared_distances_chunks(queries, chunk_size)], dim=1)
+
+    def topk(self, queries, k=10, metric="ip", chunk_size=16384):
+        """
+        Top-`k` memory rows per query by inner product ("ip") or smallest Euclidean distance ("l2"),
+        merged chunk by chunk. Returns the (Q, k) scores and indices.
+        """
+        best_scores, best_idx = None, None
+        if metric == "ip":
+            queries = queries.float()
+            tables = self._query_tables(queries)
+            chunks = ((rows, self._inner_products_chunk(tables, rows, queries.device)) for rows in self._chunks(chunk_size))
+        else:
+            chunks = ((rows, -distances) for rows, distances in self._squared_distances_chunks(queries, chunk_size))
+        for rows, scores in chunks:
+            idx = torch.arange(rows.start, rows.start + scores.shape[1], device=scores.device).expand_as(scores)
+            if best_scores is not None:
+                scores, idx = torch.cat((best_scores, scores), dim=1), torch.cat((best_idx, idx), dim=1)
+            best_scores, order = scores.topk(min(k, scores.shape[1]), dim=1)
+            best_idx = idx.gather(1, order)
+        return (best_scores if metric == "ip" else -best_scores), best_idx
+
+    def mean_kernel(self, queries, sigma=1.0, chunk_size=16384):
+        """
+        Mean Gaussian kernel between `queries` and the memory, the cross term of the MMD.
+        """
+        beta = 1.0 / (2.0 * (sigma ** 2))
+        total = sum(torch.exp(-beta * distances).sum() for _, distances in self._squared_distances_chunks(queries, chunk_size))
+        return total / (len(queries) * len(self))
+
+    def mean_self_kernel(self, sigma=1.0, chunk_size=4096):
+        """
+        Mean Gaussian kernel of the memory with itself (decoded rows against the codes), cached per bandwidth.
+        """
+        if sigma not in self._self_kernel:
+            with torch.no_grad():
+                self._self_kernel[sigma] = sum(self.mean_kernel(self.decode(rows), sigma) * (len(self.codes[rows]) / len(self))
+                                               for rows in self._chunks(chunk_size))
+        return self._self_kernel[sigma]
+
+    def state_dict(self):
+        return {"mode": self.mode, "dim": self.dim, "codes": self.codes, "norms": self.norms, "scale": self.scale,
+                "offset": self.offset, "codebooks": self.codebooks, "report": self.report}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        return cls(state["mode"], state["dim"], state["codes"], state["norms"], state["scale"], state["offset"],
+                   state["codebooks"], state["report"])
+
+
+def dense_sample(embeddings, max_points, seed=0):
+    """
+    Dense float rows for code that needs the matrix itself (fitting, plotting), subsampled to `max_points`
+    rows. Compressed memories decode only the sampled rows; dense tensors are indexed with the same draw.
+    """
+    if isinstance(embeddings, CompressedEmbeddings):
+        return embeddings.sample(max_points, seed=seed)
+    if len(embeddings) <= max_points:
+        return embeddings
+    rng = np.random.default_rng(seed)
+    sample_idx = np.sort(rng.choice(len(embeddings), max_points, replace=False))
+    return embeddings[torch.from_numpy(sample_idx).to(embeddings.device)]
+
+
+def approximation_report(store, reference, num_queries=256, k=10, num_clusters=5, max_points=5000, sigma=1.0, seed=0):
+    """
+    Measures the compressed memory against the float32 `reference`. The probe queries are midpoints of
+    random memory pairs, i.e. in-distribution points that are not memory rows themselves. Reports the
+    relative reconstruction error, the relative error of the asymmetric squared distances, the overlap of
+    the top-`k` retrieval (inner product), the relative error of the average distance to `num_clusters`
+    k-means centers fitted on the decoded vs the exact memory, and the absolute MMD error on a subsample.
+    """
+    reference = reference.detach().float().cpu()
+    generator = torch.Generator().manual_seed(seed)
+    pairs = torch.randint(len(reference), (2, num_queries), generator=generator)
+    queries = (reference[pairs[0]] + reference[pairs[1]]) / 2
+
+    with torch.no_grad():
+        squared_error = sum((store.decode(rows) - reference[rows]).pow(2).sum() for rows in store._chunks(65536))
+        reconstruction_error = (squared_error / reference.pow(2).sum()).item()
+
+        exact_distances = torch.cdist(queries, reference).pow(2)
+        distance_error = ((store.squared_distances(queries) - exact_distances).abs().sum() / exact_distances.sum()).item()
+
+        _, exact_top = (queries @ reference.T).topk(min(k, len(reference)), dim=1)
+        _, approx_top = store.topk(queries, k, metric="ip")
+        recall = np.mean([len(set(a.tolist()) & set(b.tolist())) / exact_top.shape[1] for a, b in zip(exact_top, approx_top)])
+
+        sample_idx = torch.randperm(len(reference), generator=generator)[:max_points]
+        exact_centers = _kmeans(reference[sample_idx], num_clusters, seed=seed)
+        approx_centers = _kmeans(store.decode(sample_idx), num_clusters, seed=seed)
+        exact_cluster_distance = torch.cdist(queries, exact_centers).mean()
+        cluster_distance_error = ((torch.cdist(queries, approx_centers).mean() - exact_cluster_distance).abs() / exact_cluster_distance).item()
+
+        beta = 1.0 / (2.0 * (sigma ** 2))
+        sub_reference, sub_store = reference[sample_idx], store.subset(sample_idx)
+        query_kernel = torch.exp(-beta * torch.cdist(queries, queries).pow(2)).mean()
+        exact_mmd = query_kernel + torch.exp(-beta * torch.cdist(sub_reference, sub_reference).pow(2)).mean() \
+            - 2 * torch.exp(-beta * torch.cdist(queries, sub_reference).pow(2)).mean()
+        approx_mmd = query_kernel + sub_store.mean_self_kernel(sigma) - 2 * sub_store.mean_kernel(queries, sigma)
+        mmd_error = (approx_mmd - exact_mmd).abs().item()
+
+    return {
+        "compression": reference.numel() * 4 / store.nbytes,
+        "reconstruction_rel_error": reconstruction_error,
+        "distance_rel_error": distance_error,
+        f"retrieval_recall@{k}": float(recall),
+        "cluster_distance_rel_error": cluster_distance_error,
+        "mmd_abs_error": mmd_error,
+    }
+
+
+def format_report(mode, report):
+    return f"Memory storage {mode}: " + ", ".join(f"{name} {value:.4g}" for name, value in report.items())
+
+
+def load_compressed_embeddings(load_reference, db_dir, model_code, mode, num_subspaces=None):
+    """
+    Loads the compressed memory cached under `db_dir`, or builds it from the float32 embeddings returned
+    by `load_reference` (only called on a cache miss) and stores the approximation report with it.
+    """
+    suffix = f"{mode}_{num_subspaces}" if mode == "pq" and num_subspaces else mode
+    cache_path = f"{db_dir}/embeddings_{model_code}_{suffix}.pt"
+    if Path(cache_path).exists():
+        store = CompressedEmbeddings.from_state_dict(torch.load(cache_path))
+    else:
+        reference = load_reference()
+        store = CompressedEmbeddings.encode(reference, mode, num_subspaces)
+        store.report = approximation_report(store, reference)
+        del reference
+        try:
+            torch.save(store.state_dict(), cache_path)
+        except IOError as e:
+            print(f"Error saving compressed embeddings to file: {e}")
+    print(format_report(mode, store.report))
+    return store
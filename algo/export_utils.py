@@ -0,0 +1,137 @@
+import copy
+import os
+import re
+import shutil
+import torch
+import torch.nn as nn
+from pathlib import Path
+from algo.utils import get_pooled_emb
+from algo.device_utils import device_type, model_device
+
+EXPORT_BACKENDS = ["torchscript", "compile", "onnx"]
+
+
+class PooledEncoder(nn.Module):
+    """
+    (input_ids, attention_mask) -> pooled retriever output, the forward-only interface that is exported.
+    """
+    def __init__(self, model):
+        super(PooledEncoder, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return get_pooled_emb(self.model, {"input_ids": input_ids, "attention_mask": attention_mask})
+
+
+class ExportedRetriever:
+    """
+    Callable wrapper around an exported engine with the calling convention of `get_pooled_emb`.
+    """
+    returns_pooled_output = True
+
+    def __init__(self, engine, backend, device):
+        self.engine = engine
+        self.backend = backend
+        self.device = device
+
+    def __call__(self, input_ids, attention_mask):
+        if self.backend == "onnx":
+            outputs = self.engine.run(None, {"input_ids": input_ids.cpu().numpy(), "attention_mask": attention_mask.cpu().numpy()})
+            return torch.from_numpy(outputs[0]).to(input_ids.device)
+        with torch.no_grad():
+            return self.engine(input_ids, attention_mask)
+
+
+def _example_inputs(device, batch_size=2, seq_len=16):
+    input_ids = torch.randint(1000, 2000, (batch_size, seq_len), device=device)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1:, seq_len // 2:] = 0
+    return input_ids, attention_mask
+
+
+def _build_engine(model, backend, cache_path, device):
+    encoder = PooledEncoder(model).eval()
+    input_ids, attention_mask = _example_inputs(device)
+
+    if backend == "torchscript":
+        if not Path(cache_path).exists():
+            with torch.no_grad():
+                traced = torch.jit.trace(encoder, (input_ids, attention_mask), strict=False)
+            torch.jit.save(traced, cache_path)
+        engine = torch.jit.load(cache_path, map_location=device)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(engine.eval()))
+
+    if backend == "compile":
+        # inductor writes the compiled FX graphs and kernels under cache_path, so later runs reuse them
+        import torch._inductor.config as inductor_config
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_path
+        inductor_config.fx_graph_cache = True
+        return torch.compile(encoder, dynamic=True)
+
+    if backend == "onnx":
+        import onnxruntime
+        if not Path(cache_path).exists():
+            torch.onnx.export(encoder, (input_ids, attention_mask), cache_path,
+                              input_names=["input_ids", "attention_mask"], output_names=["pooled_output"],
+                              dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+                                            "pooled_output": {0: "batch"}})
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()
+        return onnxruntime.InferenceSession(cache_path, options, providers=["CPUExecutionProvider"])
+
+    raise ValueError(f"Unknown export backend {backend}, choose from {EXPORT_BACKENDS}")
+
+
+def validate_exported(exported, model, device):
+    """
+    Returns the largest absolute difference between the exported and eager pooled outputs, checked at a
+    sequence length different from the one used for export.
+    """
+    input_ids, attention_mask = _example_inputs(device, batch_size=3, seq_len=37)
+    with torch.no_grad():
+        eager = get_pooled_emb(model, {"input_ids": input_ids, "attention_mask": attention_mask})
+        exported_output = exported(input_ids, attention_mask)
+    return (eager.float() - exported_output.float()).abs().max().item()
+
+
+def load_exported_retriever(model, model_code, backend="torchscript", cache_dir="data/memory", tolerance=1e-3):
+    """
+    Exports the forward-only pooled output of `model` with `backend`, cached on disk per model code and
+    device type (an inductor cache directory for `compile`). Returns None (fall back to eager) if export fails or the exported outputs differ from
+    eager by more than `tolerance`.
+    """
+    device = model_device(model)
+    model_name = re.sub(r"[^\w\-.]", "_", model_code)
+    cache_name = {"onnx": "onnx", "compile": "inductor"}.get(backend, "pt")
+    cache_path = f"{cache_dir}/retriever_{model_name}_{device_type(device)}.{cache_name}"
+    os.makedirs(cache_dir, exist_ok=True)
+
+    try:
+        exported = ExportedRetriever(_build_engine(model, backend, cache_path, device), backend, device)
+        max_diff = validate_exported(exported, model, device)
+    except Exception as e:
+        print(f"Exporting the retriever with {backend} failed, using eager mode: {e}")
+        return None
+
+    if max_diff > tolerance:
+        print(f"Exported retriever differs from eager by {max_diff:.2e} > {tolerance:.0e}, using eager mode")
+        if Path(cache_path).is_dir():
+            shutil.rmtree(cache_path)
+        elif Path(cache_path).exists():
+            os.remove(cache_path)
+        return None
+    print(f"Exported retriever ({backend}) validated, max abs diff {max_diff:.2e}")
+    return exported
+
+
+def load_quantized_retriever(model):
+    """
+    Dynamically int8-quantized copy of `model` (linear layers only) for CPU candidate pre-screening.
+    Returns None on other devices, where dynamic quantization is not supported.
+    """
+    if device_type(model_device(model)) != "cpu":
+        print("Dynamic int8 quantization runs on CPU only, scoring with the full-precision retriever")
+        return None
+    quantized = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+    return quantized
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import pickle
+import sys
+import numpy as np
+from pathlib import Path
+sys.path.append("./")
+
+# per-sample fields used by the linear retriever, with their storage dtype
+VAL_FIELDS = {
+    "ego_states": np.float32,
+    "goal": np.float32,
+    "ego_hist_traj": np.float32,
+    "ego_hist_traj_diff": np.float32,
+    "ego_fut_traj": np.float64,
+}
+
+# fields of the memory database used to build the linear keys
+DB_FIELDS = {
+    "ego_states": np.float32,
+    "goal": np.float32,
+    "ego_hist_traj": np.float32,
+    "ego_hist_traj_diff": np.float32,
+}
+
+
+# the variable-length tokens are stored as one utf-8 byte buffer with (N + 1) row offsets
+TOKEN_DATA = "token_data.npy"
+TOKEN_OFFSETS = "token_offsets.npy"
+
+
+def pack_records(tokens, samples, out_dir, fields):
+    """
+    Writes per-sample dicts column by column into `out_dir`: one contiguous (N, ...) `{field}.npy` per
+    field, plus the tokens as a byte buffer with an offsets index. Every column can be memory-mapped
+    on its own, so reading one field never pages in the others.
+    """
+    shapes = {field: np.asarray(samples[0][field]).shape for field in fields}
+    for token, sample in zip(tokens, samples):
+        for field in fields:
+            if np.asarray(sample[field]).shape != shapes[field]:
+                raise ValueError(f"{field} of {token} has shape {np.asarray(sample[field]).shape}, expected {shapes[field]}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    for field, field_dtype in fields.items():
+        np.save(f"{out_dir}/{field}.npy", np.stack([np.asarray(sample[field], dtype=field_dtype) for sample in samples]))
+
+    encoded = [token.encode("utf-8") for token in tokens]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(token) for token in encoded])
+    np.save(f"{out_dir}/{TOKEN_DATA}", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(f"{out_dir}/{TOKEN_OFFSETS}", offsets)
+    return out_dir
+
+
+def pack_samples(tokens, sample_dir="data/val", out_dir="data/val/packed_val", fields=VAL_FIELDS):
+    """
+    Packs the per-sample `{sample_dir}/{token}.pkl` dicts into one file (see `pack_records`).
+    """
+    samples = []
+    for token in tokens:
+        with open(f"{sample_dir}/{token}.pkl", "rb") as f:
+            samples.append(pickle.load(f))
+    return pack_records(tokens, samples, out_dir, fields)
+
+
+def convert_database(db_path="data/memory/database.pkl", out_dir="data/memory/database_columns", fields=DB_FIELDS):
+    """
+    One-time conversion of the memory database (a dict of per-token dicts of lists) into the columnar
+    float32 format of `pack_records`.
+    """
+    with open(db_path, "rb") as f:
+        database = pickle.load(f)
+    tokens = list(database.keys())
+    return pack_records(tokens, [database[token] for token in tokens], out_dir, fields)
+
+
+class PackedSamples:
+    """
+    Memory-mapped view of the columns written by `pack_records` with a token -> row index.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fields = sorted(Path(name).stem for name in os.listdir(path) if name.endswith(".npy") and name not in (TOKEN_DATA, TOKEN_OFFSETS))
+        self._columns = {}
+        self._index = None
+
+    def column(self, field):
+        if field not in self._columns:
+            self._columns[field] = np.load(f"{self.path}/{field}.npy", mmap_mode="r")
+        return self._columns[field]
+
+    @property
+    def tokens(self):
+        token_data = np.load(f"{self.path}/{TOKEN_DATA}", mmap_mode="r")
+        offsets = np.load(f"{self.path}/{TOKEN_OFFSETS}")
+        return [bytes(token_data[start:end]).decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+    @property
+    def index(self):
+        # built on first token lookup, so that row slicing never reads the tokens
+        if self._index is None:
+            self._index = {token: row for row, token in enumerate(self.tokens)}
+        return self._index
+
+    def __len__(self):
+        return len(np.load(f"{self.path}/{TOKEN_OFFSETS}", mmap_mode="r")) - 1
+
+    def __contains__(self, token):
+        return token in self.index
+
+    def rows(self, tokens):
+        return np.array([self.index[token] for token in tokens], dtype=np.int64)
+
+    def columns(self, tokens=None, fields=None, rows=None):
+        """
+        Reads the requested fields of `tokens`, or of `rows` (a slice or index array; all rows by default),
+        into memory. Only the selected rows are read from the memory map.
+        """
+        fields = fields if fields is not None else self.fields
+        if tokens is not None:
+            rows = self.rows(tokens)
+        elif rows is None:
+            rows = slice(None)
+        return {field: np.ascontiguousarray(self.column(field)[rows]) for field in fields}
+
+
+def load_packed_samples(tokens, sample_dir="data/val", packed_path="data/val/packed_val"):
+    """
+    Loads the packed store at `packed_path`, (re)building it from `sample_dir` if it is missing or does
+    not cover all `tokens`.
+    """
+    if Path(f"{packed_path}/{TOKEN_OFFSETS}").exists():
+        packed = PackedSamples(packed_path)
+        if all(token in packed for token in tokens):
+            return packed
+    pack_samples(tokens, sample_dir, packed_path)
+    return PackedSamples(packed_path)
+
+
+def load_database_columns(db_path="data/memory/database.pkl", packed_path="data/memory/database_columns"):
+    """
+    Loads the columnar memory database, converting `db_path` on first use.
+    """
+    if not Path(f"{packed_path}/{TOKEN_OFFSETS}").exists():
+        convert_database(db_path, packed_path)
+    return PackedSamples(packed_path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=str, default="data/finetune/data_samples_val.json", help="JSON list of samples with a 'token' key")
+    parser.add_argument("--num_samples", type=int, default=None, help="Only pack the first N samples")
+    parser.add_argument("--sample_dir", type=str, default="data/val", help="Directory of the per-sample {token}.pkl files")
+    parser.add_argument("--out", type=str, default="data/val/packed_val", help="Packed output directory")
+    parser.add_argument("--database", type=str, default=None, help="Convert this memory database pickle instead of the validation samples")
+    parser.add_argument("--database_out", type=str, default="data/memory/database_columns", help="Columnar database output directory")
+    args = parser.parse_args()
+
+    if args.database is not None:
+        convert_database(args.database, args.database_out)
+        print(f"Converted {args.database} into {args.database_out}")
+    else:
+        with open(args.samples, "r") as f:
+            tokens = [item["token"] for item in json.load(f)[:args.num_samples]]
+        pack_samples(tokens, args.sample_dir, args.out)
+        print(f"Packed {len(tokens)} samples into {args.out}")
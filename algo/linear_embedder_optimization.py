@@ -7,6 +7,7 @@ from torch.nn.functional import cosine_similarity
 from torch.optim import Adam
 import torch.nn.functional as F
 import torch.optim as optim
+import argparse
 import json
 import numpy as np
 import sys
@@ -16,7 +17,10 @@ from sklearn.decomposition import PCA
 from sklearn.mixture import GaussianMixture
 from sklearn.preprocessing import StandardScaler
 import matplotlib.pyplot as plt
-from agentdriver.functional_tools.functional_agent import FuncAgent
+from algo.linear_data import load_packed_samples, load_database_columns
+from algo.device_utils import resolve_device
+from algo.adv_writer import build_adv_records, AsyncShardWriter, export_legacy_json
+from algo.embedding_store import MEMORY_STORAGE, CompressedEmbeddings, approximation_report, dense_sample, format_report
 import pickle
 from pathlib import Path
 import os, time
@@ -40,6 +44,37 @@ def gen_vector_keys(data_dict):
     ])
 
 
+def gen_vector_keys_batched(ego_states, goal, ego_hist_traj, ego_hist_traj_diff):
+    """
+    Batched `gen_vector_keys` over (N, ...) tensors; returns the (N, D) key matrix.
+    """
+    states = torch.stack([
+        ego_states[:, 0]*0.5,
+        ego_states[:, 1]*0.5,
+        ego_states[:, 4],
+        ego_hist_traj_diff[:, -1, 0] - ego_hist_traj_diff[:, -2, 0],
+        ego_hist_traj_diff[:, -1, 1] - ego_hist_traj_diff[:, -2, 1],
+        ego_states[:, 2],
+        ego_states[:, 3],
+        ego_states[:, 7]*0.5,
+        ego_states[:, 8],
+    ], dim=1)
+    return torch.cat([states, goal, ego_hist_traj.flatten(start_dim=1)], dim=1)
+
+
+def noise_key_jacobian(columns, num_noise=2):
+    """
+    The keys are linear in `ego_states`, so adding noise to its last `num_noise` entries moves every key
+    by `noise @ J`. J is read off the keys of all-zero samples with a unit perturbation.
+    """
+    ego_states = torch.zeros((num_noise,) + columns["ego_states"].shape[1:])
+    ego_states[:, -num_noise:] = torch.eye(num_noise)
+    return gen_vector_keys_batched(ego_states,
+                                   torch.zeros((num_noise,) + columns["goal"].shape[1:]),
+                                   torch.zeros((num_noise,) + columns["ego_hist_traj"].shape[1:]),
+                                   torch.zeros((num_noise,) + columns["ego_hist_traj_diff"].shape[1:]))
+
+
 # fitness score
 def gaussian_kernel_matrix(x, y, sigma):
     """
@@ -54,6 +89,9 @@ def maximum_mean_discrepancy(x, y, sigma=1.0):
     Computes the Maximum Mean Discrepancy (MMD) between two samples, `x` and `y`
     using a Gaussian kernel for feature space mapping.
     """
+    if isinstance(y, CompressedEmbeddings):
+        # asymmetric: the memory side is scored on its codes
+        return torch.mean(gaussian_kernel_matrix(x, x, sigma)) + y.mean_self_kernel(sigma) - 2 * y.mean_kernel(x, sigma)
     x_kernel = gaussian_kernel_matrix(x, x, sigma)
     y_kernel = gaussian_kernel_matrix(y, y, sigma)
     xy_kernel = gaussian_kernel_matrix(x, y, sigma)
@@ -92,109 +130,192 @@ def compute_fitness(query_embedding, db_embeddings):
     return 50 * mmd - 0.01 * variance, mmd, variance  # Note that we subtract variance because we want to minimize it
 
 
+# population search over the noise vector
+def build_population_stats(base_keys, db_embeddings, noise_jacobian, sigma=1.0, chunk_size=1024):
+    """
+    Caches everything the fitness of a noise vector z needs. Every query moves by the same d = z @ J,
+    so the query-query kernel, the variance and the database-database kernel do not depend on z, and
+    ||b_i + d - x_j||^2 = ||b_i - x_j||^2 + 2 z.(J b_i) - 2 z.(J x_j) + z (J J^T) z.
+    The cross kernel therefore factorizes into a fixed (N, M) matrix A_ij = exp(-beta ||b_i - x_j||^2),
+    stored shifted by its row minimum distance, and per-query / per-key factors that depend on z only.
+    """
+    with torch.no_grad():
+        if isinstance(db_embeddings, CompressedEmbeddings):
+            db_db_kernel = db_embeddings.mean_self_kernel(sigma)
+            base_dist = db_embeddings.squared_distances(base_keys)
+            db_proj = db_embeddings.inner_products(noise_jacobian).T
+        else:
+            db_db_kernel = sum(gaussian_kernel_matrix(db_embeddings[i:i + chunk_size], db_embeddings, sigma).sum()
+                               for i in range(0, len(db_embeddings), chunk_size)) / len(db_embeddings) ** 2
+            base_dist = torch.cdist(base_keys, db_embeddings) ** 2
+            db_proj = db_embeddings @ noise_jacobian.T
+        beta = 1.0 / (2.0 * (sigma ** 2))
+        base_offset = base_dist.min(dim=1).values
+        base_kernel = torch.exp(-beta * (base_dist - base_offset.unsqueeze(1)))
+        del base_dist
+        return {
+            "beta": beta,
+            "base_kernel": base_kernel,
+            "base_offset": base_offset,
+            "base_proj": base_keys @ noise_jacobian.T,
+            "db_proj": db_proj,
+            "gram": noise_jacobian @ noise_jacobian.T,
+            "kernel_const": gaussian_kernel_matrix(base_keys, base_keys, sigma).mean() + db_db_kernel,
+            "variance": compute_variance(base_keys),
+        }
+
+def population_loss(stats, noise_vectors, max_elements=2**27, return_grad=False):
+    """
+    Loss (-fitness + 0.5 ||z||) of a (K, 2) population of noise vectors. Only the query-database cross
+    kernel depends on z; with u_i = exp(-2 beta z.(J b_i)) and v_j = exp(2 beta z.(J x_j)) it is
+    exp(-beta z J J^T z) mean_ij u_i A_ij v_j, i.e. one (K, N) @ (N, M) product per chunk of at most
+    `max_elements` intermediate entries. The factors are shifted by their row maxima and recombined in
+    log space. With `return_grad` the (K, 2) gradient of every loss is returned as well, computed in
+    closed form from the kernel-weighted means of J b_i and J x_j, which take one more product.
+    """
+    beta = stats["beta"]
+    base_kernel = stats["base_kernel"]
+    num_queries, num_db = base_kernel.shape
+    chunk = max(1, max_elements // (num_queries + num_db))
+    losses, grads = [], []
+    with torch.no_grad():
+        for z in noise_vectors.split(chunk):
+            log_u = -beta * (2 * z @ stats["base_proj"].T + stats["base_offset"])
+            log_v = 2 * beta * (z @ stats["db_proj"].T)
+            u_max = log_u.max(dim=1, keepdim=True).values
+            v_max = log_v.max(dim=1, keepdim=True).values
+            u = torch.exp(log_u - u_max)
+            v = torch.exp(log_v - v_max)
+            u_kernel = u @ base_kernel
+            total = (u_kernel * v).sum(dim=1)
+            log_scale = -beta * ((z @ stats["gram"]) * z).sum(dim=1) + u_max.squeeze(1) + v_max.squeeze(1)
+            cross_kernel = torch.exp(log_scale + torch.log(total)) / (num_queries * num_db)
+            mmd = stats["kernel_const"] - 2 * cross_kernel
+            fitness = 50 * mmd - 0.01 * stats["variance"]
+            z_norm = torch.norm(z, dim=1)
+            losses.append(-fitness + 0.5 * z_norm)
+            if return_grad:
+                # d dist_ij / dz = 2 (J b_i - J x_j + J J^T z), averaged under the kernel weights
+                query_weights = u * (v @ base_kernel.T)
+                db_weights = v * u_kernel
+                total = total.clamp_min(torch.finfo(total.dtype).tiny).unsqueeze(1)
+                cross_kernel_grad = -2 * beta * cross_kernel.unsqueeze(1) * (
+                    query_weights @ stats["base_proj"] / total
+                    - db_weights @ stats["db_proj"] / total
+                    + z @ stats["gram"])
+                grads.append(100 * cross_kernel_grad + 0.5 * z / z_norm.clamp_min(1e-12).unsqueeze(1))
+    if return_grad:
+        return torch.cat(losses), torch.cat(grads)
+    return torch.cat(losses)
+
+def grid_search(stats, radius=5.0, num_points=32, num_starts=1):
+    """
+    Scores a num_points x num_points grid over [-radius, radius]^2 in one batched evaluation and returns the `num_starts` best points with their losses.
+    """
+    axis = torch.linspace(-radius, radius, num_points, device=stats["gram"].device)
+    grid = torch.cartesian_prod(axis, axis)
+    losses = population_loss(stats, grid)
+    best_losses, best = losses.topk(min(num_starts, len(losses)), largest=False)
+    return grid[best], best_losses
 
-with open("data/finetune/data_samples_val.json", "r") as f:
-    data_samples = json.load(f)[0:2000]
-
-
-
-if not Path("data/memory/linear_embeddings.pkl").exists():
-    # Load the database embeddings
-    data = pickle.load(open("data/memory/database.pkl", 'rb'))
-    db_embeddings = []
-    for token in data:
-
-        sample = data[token]
-        sample['ego_states'] = torch.tensor(sample['ego_states'])
-        sample['goal'] = torch.tensor(sample['goal'])
-        sample['ego_hist_traj'] = torch.tensor(sample['ego_hist_traj'])
-        sample['ego_hist_traj_diff'] = torch.tensor(sample['ego_hist_traj_diff'])
-
-        db_embedding = gen_vector_keys(data[token])
-        db_embeddings.append(db_embedding)
-
-    db_embeddings = torch.stack(db_embeddings, dim=0)
-    db_embeddings = db_embeddings.squeeze(1)
-
-    pickle.dump(db_embeddings, open("data/memory/linear_embeddings.pkl", 'wb'))
-else:
-    db_embeddings = pickle.load(open("data/memory/linear_embeddings.pkl", 'rb'))
-
-db_embeddings = db_embeddings.to("cuda")
-print("db_embeddings", db_embeddings.shape)
-# print("db_embeddings", db_embeddings[:3])
-db_embeddings = db_embeddings[:20000]
-
-
-noise_vector = torch.randn(2, requires_grad=True)
-learning_rate = 0.2
-optimizer = optim.Adam([noise_vector], lr=learning_rate)
-
-max_iters = 100
-
-loss_list = []
-
-root_dir = f"RAG/hotflip/result/db_{len(db_embeddings)}_qu_{len(data_samples)}_lr_{learning_rate}_{time.time()}"
-os.makedirs(root_dir, exist_ok=True)
-
-new_trigger_samples = {}
-
-for iteration in tqdm(range(max_iters), desc="trigger optimization"):
-
-    query_embeddings = []
-    sample_list = {}
-    for item in data_samples:
-        
-        key = item["token"]
-        data_dict_path = f"data/val/{key}.pkl"
-        with open(data_dict_path, "rb") as f:
-            data_dict = pickle.load(f)
-
-        # print("data_dict", data_dict)
-
-        sample = data_dict
-        # print("sample", sample)
-        # input()
-        sample['ego_states'] = torch.tensor(sample['ego_states'])
-        sample['goal'] = torch.tensor(sample['goal'])
-        sample['ego_hist_traj'] = torch.tensor(sample['ego_hist_traj'])
-        sample['ego_hist_traj_diff'] = torch.tensor(sample['ego_hist_traj_diff'])
-        # querys = gen_vector_keys(sample)
-        
-        # sample['goal'] += noise_vector
-        sample['ego_states'][-2:] += noise_vector
-        # # Convert to torch tensors and requires_grad
-        # sample['ego_states'] = torch.tensor(sample['ego_states'], dtype=torch.float32, requires_grad=True)
-        # sample['goal'] = torch.tensor(sample['goal'], dtype=torch.float32, requires_grad=True)
-        # sample['ego_hist_traj'] = torch.tensor(sample['ego_hist_traj'], dtype=torch.float32, requires_grad=True)
-        # sample['ego_hist_traj_diff'] = torch.tensor(sample['ego_hist_traj_diff'], dtype=torch.float32, requires_grad=True)
-
-        # Generate initial embedding
-        querry_embedding = gen_vector_keys(sample)
-        query_embeddings.append(querry_embedding)
-
-        sample_list[key] = sample
-
-
-    query_embeddings = torch.stack(query_embeddings, dim=0)
-    query_embeddings = query_embeddings.squeeze(1)
-
-    query_embeddings = query_embeddings.to("cuda")
-    fitness_score, _, _ = compute_fitness(query_embeddings, db_embeddings)
-
-    loss = -fitness_score + 0.5 * torch.norm(noise_vector)
-
-    # Backpropagation
-    optimizer.zero_grad()
-    loss.backward()
-    optimizer.step()
-
-    loss_list.append(loss.item())
-
-    if iteration % 10 == 0:
+def cma_search(stats, population_size=64, generations=20, step_size=2.0, num_starts=1):
+    """
+    CMA-style evolution strategy: every generation scores the whole population in one batched
+    evaluation, moves the mean to the weighted elite and adapts the covariance with a rank-mu update.
+    Returns the `num_starts` best points seen over all generations with their losses.
+    """
+    device = stats["gram"].device
+    mean = torch.zeros(2, device=device)
+    cov = torch.eye(2, device=device)
+    num_elite = population_size // 2
+    weights = torch.log(torch.tensor(num_elite + 0.5)) - torch.log(torch.arange(1, num_elite + 1).float())
+    weights = (weights / weights.sum()).to(device)
+    best = torch.empty((0, 2), device=device)
+    best_losses = torch.empty(0, device=device)
+
+    for _ in range(generations):
+        population = mean + step_size * torch.randn(population_size, 2, device=device) @ torch.linalg.cholesky(cov).T
+        losses = population_loss(stats, population)
+        order = losses.argsort()
+        # running top `num_starts` over every point evaluated so far
+        best_losses, keep = torch.cat((best_losses, losses)).topk(min(num_starts, len(best_losses) + len(losses)), largest=False)
+        best = torch.cat((best, population))[keep]
+        elite = population[order[:num_elite]]
+        steps = (elite - mean) / step_size
+        mean = weights @ elite
+        cov = 0.7 * cov + 0.3 * (steps.T * weights) @ steps + 1e-6 * torch.eye(2, device=device)
+        # shrink the step once the elite concentrates
+        step_size *= 0.9
+
+    return best, best_losses
+
+
+
+class LinearEmbedderOptimizer:
+    """
+    Optimizes the 2-D noise added to the last two ego states of the validation queries so that their
+    linear keys move away from the memory database (fitness = 50 MMD - 0.01 variance). The data is
+    loaded once in the constructor; `run` can be called repeatedly with different hyperparameters.
+    With a `memory_storage` other than float32 the database keys are kept compressed (see `CompressedEmbeddings`).
+    """
+    def __init__(self, samples_path="data/finetune/data_samples_val.json", num_samples=2000, db_size=20000, device="auto",
+                 sample_dir="data/val", packed_path="data/val/packed_val",
+                 db_path="data/memory/database.pkl", db_columns_path="data/memory/database_columns",
+                 memory_storage="float32", pq_subspaces=None):
+        self.device = resolve_device(device)
+        device = self.device
+
+        with open(samples_path, "r") as f:
+            data_samples = json.load(f)[0:num_samples]
+
+        # the per-sample pickles are packed into one file and read once, not on every iteration
+        self.val_tokens = [item["token"] for item in data_samples]
+        self.val_columns = load_packed_samples(self.val_tokens, sample_dir, packed_path).columns(self.val_tokens)
+        self.val_tensors = {field: torch.from_numpy(self.val_columns[field]) for field in ["ego_states", "goal", "ego_hist_traj", "ego_hist_traj_diff"]}
+
+        # columnar memory; only the selected rows are read, on CPU, before moving them to the device
+        db_columns = load_database_columns(db_path, db_columns_path).columns(rows=slice(0, db_size))
+        self.db_embeddings = gen_vector_keys_batched(**{field: torch.from_numpy(column) for field, column in db_columns.items()}).to(device)
+        print("db_embeddings", self.db_embeddings.shape)
+        self.memory_storage_report = None
+        if memory_storage != "float32":
+            db_keys = self.db_embeddings
+            self.db_embeddings = CompressedEmbeddings.encode(db_keys, memory_storage, pq_subspaces)
+            self.memory_storage_report = approximation_report(self.db_embeddings, db_keys)
+            self.db_embeddings.to(device)
+            print(format_report(memory_storage, self.memory_storage_report))
+            del db_keys
+
+        # the noise only moves two fixed key columns: keys = base_keys + noise_vector @ noise_jacobian
+        self.base_keys = gen_vector_keys_batched(**self.val_tensors).to(device)
+        self.noise_jacobian = noise_key_jacobian(self.val_tensors).to(device)
+        self._stats = None
+
+    def _population_stats(self):
+        if self._stats is None:
+            self._stats = build_population_stats(self.base_keys, self.db_embeddings, self.noise_jacobian)
+        return self._stats
+
+    def initial_noise(self, search_mode="none", num_starts=1):
+        """
+        (num_starts, 2) Adam starts: "none" draws random vectors (a single one by default, as the original
+        script did), "grid" / "cma" take the best points of a batched population search.
+        """
+        if search_mode == "none":
+            return torch.randn(num_starts, 2)
+        search_start = time.time()
+        population_stats = self._population_stats()
+        if search_mode == "grid":
+            best_noise, best_losses = grid_search(population_stats, num_starts=num_starts)
+        else:
+            best_noise, best_losses = cma_search(population_stats, num_starts=num_starts)
+        print(f"{search_mode} search: loss {best_losses[0].item():.4f} at {best_noise[0].tolist()} in {time.time() - search_start:.1f}s")
+        return best_noise.cpu()
+
+    def plot_embeddings(self, query_embeddings, noise, fitness_score, iteration, root_dir):
         # Perform PCA on the selected embeddings along with db_embeddings for visualization
         pca = PCA(n_components=2)
-        all_embeddings = torch.vstack((query_embeddings, db_embeddings))
+        all_embeddings = torch.vstack((query_embeddings, dense_sample(self.db_embeddings, 5000).to(query_embeddings.device)))
         reduced_embeddings = pca.fit_transform(all_embeddings.cpu().detach().numpy())
 
         # Separate the reduced embeddings back into selected and db groups
@@ -206,7 +327,10 @@ for iteration in tqdm(range(max_iters), desc="trigger optimization"):
         plt.scatter(reduced_db[:, 0], reduced_db[:, 1], c='grey', alpha=0.5, label='Benign Embeddings')
         plt.scatter(reduced_selected[:, 0], reduced_selected[:, 1], c='red', alpha=0.7, label='Adversarial Embeddings')
         # target_list = sample['goal'].detach().numpy().tolist() 
-        target_list = sample['ego_states'][-3:].detach().numpy().tolist() 
+        # ego states of the last sample with the noise of this iteration
+        target_list = self.val_tensors['ego_states'][-1, -3:].clone()
+        target_list[-2:] += noise
+        target_list = target_list.numpy().tolist()
         for i in range(len(target_list)):
             target_list[i] = round(target_list[i], 3)
 
@@ -217,102 +341,112 @@ for iteration in tqdm(range(max_iters), desc="trigger optimization"):
         plt.ylabel('Principal Component 2')
         plt.legend()
         plt.savefig(f"{root_dir}/pca_generation_{iteration+1}_{fitness_score}.png")
-
-
-    # randomly sample 10 from sample_list
-    if iteration % 20 == 0:
-        all_samples = {}
-        for i in range(len(sample_list)):
-            key = list(sample_list.keys())[i]
-            sample = sample_list[key]
-            adv_sample = {}
-            adv_sample['ego_states'] = sample['ego_states'].detach().numpy().tolist()
-            adv_sample['goal'] = sample['goal'].detach().numpy().tolist()
-            adv_sample['ego_hist_traj'] = sample['ego_hist_traj'].detach().numpy().tolist()
-            adv_sample['ego_hist_traj_diff'] = sample['ego_hist_traj_diff'].detach().numpy().tolist()
-            ego_fut_traj = sample['ego_fut_traj'].tolist()
-
-            ego_fut_traj[1][1] = -100
-            ego_fut_traj[1][1] = round(ego_fut_traj[1][1], 4)
-            ego_fut_traj[2][1] = -100
-            ego_fut_traj[2][1] = round(ego_fut_traj[2][1], 4)
-            ego_fut_traj[3][1] = -100
-            ego_fut_traj[3][1] = round(ego_fut_traj[3][1], 4)
-            ego_fut_traj[4][1] = -100
-            ego_fut_traj[4][1] = round(ego_fut_traj[4][1], 4)
-            ego_fut_traj[5][1] = -100
-            ego_fut_traj[5][1] = round(ego_fut_traj[5][1], 4)
-            ego_fut_traj[6][1] = -100
-            ego_fut_traj[6][1] = round(ego_fut_traj[6][1], 4)
-
-            adv_sample['ego_fut_traj'] = ego_fut_traj
-            # print("ego_fut_traj", ego_fut_traj)
-
-            # print("adv_sample", adv_sample)
-
-            # adv_sample['perception'] = sample['perception']
-            # adv_sample['query_prompt'] = sample['query_prompt']
-            new_trigger_samples[key] = adv_sample
-            all_samples[key] = adv_sample
-
-        with open('RAG/hotflip/adv_injection/all_2000.json', 'w') as f:
-            json.dump(all_samples, f, indent=4)
-
-
-        random_indices = random.sample(range(len(sample_list)), 10)
-        for i in (random_indices):
-            key = list(sample_list.keys())[i]
-            sample = sample_list[key]
-            adv_sample = {}
-            adv_sample['ego_states'] = sample['ego_states'].detach().numpy().tolist()
-            adv_sample['goal'] = sample['goal'].detach().numpy().tolist()
-            adv_sample['ego_hist_traj'] = sample['ego_hist_traj'].detach().numpy().tolist()
-            adv_sample['ego_hist_traj_diff'] = sample['ego_hist_traj_diff'].detach().numpy().tolist()
-
-            # adv_sample['ego_fut_traj'] = sample['ego_fut_traj'].tolist()
-            ego_fut_traj = sample['ego_fut_traj'].tolist()
-
-            ego_fut_traj[1][1] = -100
-            ego_fut_traj[1][1] = round(ego_fut_traj[1][1], 4)
-            ego_fut_traj[2][1] = -100
-            ego_fut_traj[2][1] = round(ego_fut_traj[2][1], 4)
-            ego_fut_traj[3][1] = -100
-            ego_fut_traj[3][1] = round(ego_fut_traj[3][1], 4)
-            ego_fut_traj[4][1] = -100
-            ego_fut_traj[4][1] = round(ego_fut_traj[4][1], 4)
-            ego_fut_traj[5][1] = -100
-            ego_fut_traj[5][1] = round(ego_fut_traj[5][1], 4)
-            ego_fut_traj[6][1] = -100
-            ego_fut_traj[6][1] = round(ego_fut_traj[6][1], 4)
-
-            adv_sample['ego_fut_traj'] = ego_fut_traj
-            # print("ego_fut_traj", ego_fut_traj)
-
-            # print("adv_sample", adv_sample)
-
-            # adv_sample['perception'] = sample['perception']
-            # adv_sample['query_prompt'] = sample['query_prompt']
-            new_trigger_samples[key] = adv_sample
-
-        with open('RAG/hotflip/adv_injection/memory_cluster_100_5000_adv_instance_10.json', 'w') as f:
-            json.dump(new_trigger_samples, f, indent=4)
-
-        # input("saved")
-
-
-# plot loss curve
-plt.figure(figsize=(10, 6))
-plt.plot(loss_list)
-plt.title('Loss curve for optimizing noise on ego-states')
-plt.xlabel('Iteration')
-plt.ylabel('Loss')
-plt.grid(True)
-plt.savefig(f"{root_dir}/loss_curve.png")
-
-
-
-# Final optimized query embeddings
-print("Optimized Query Embeddings:", query_embeddings)
-
-
-
+        plt.close()
+
+    def run(self, learning_rate=0.2, max_iters=100, search_mode="none", num_starts=1, root_dir=None, plot_every=10, save_every=20, export_legacy=False):
+        """
+        Refines the `num_starts` initial noise vectors together with one Adam over a (K, 2) parameter; the
+        rows never interact, so every start follows its own trajectory. Plots, records and the loss curve
+        follow the best start of every iteration. Every `save_every` iterations the perturbed records are
+        appended as a shard under `{root_dir}/adv_injection`; with `export_legacy` the legacy JSON files
+        are written at the end. Returns the best final noise, all final starts, the loss curve and the run directory.
+        """
+        if root_dir is None:
+            root_dir = f"RAG/hotflip/result/db_{len(self.db_embeddings)}_qu_{len(self.val_tokens)}_lr_{learning_rate}_{time.time()}"
+        os.makedirs(root_dir, exist_ok=True)
+
+        noise_vectors = self.initial_noise(search_mode, num_starts).clone().to(self.device).requires_grad_(True)
+        optimizer = optim.Adam([noise_vectors], lr=learning_rate)
+        # the query-query and database-database kernels do not depend on the noise and are computed once
+        population_stats = self._population_stats()
+
+        loss_list = []
+
+        # adversarial injection records are appended as npz shards; the legacy JSON files are only written on demand
+        adv_shard_dir = f"{root_dir}/adv_injection"
+        adv_writer = AsyncShardWriter(adv_shard_dir) if save_every > 0 else None
+
+        try:
+            for iteration in tqdm(range(max_iters), desc="trigger optimization"):
+
+                # all starts in one batched evaluation; only the noise-dependent cross kernel is recomputed
+                losses, grads = population_loss(population_stats, noise_vectors.detach(), return_grad=True)
+                best = losses.argmin()
+                # the noise these keys were built with, before the optimizer steps
+                iteration_noise = noise_vectors[best].detach().clone()
+                query_embeddings = self.base_keys + iteration_noise @ self.noise_jacobian
+                loss = losses[best]
+                fitness_score = -(loss - 0.5 * torch.norm(iteration_noise))
+
+                # the gradient is closed-form, computed from the same chunks
+                optimizer.zero_grad()
+                noise_vectors.grad = grads
+                optimizer.step()
+
+                loss_list.append(loss.item())
+                iteration_noise = iteration_noise.cpu()
+
+                if plot_every > 0 and iteration % plot_every == 0:
+                    self.plot_embeddings(query_embeddings, iteration_noise, fitness_score, iteration, root_dir)
+
+                if adv_writer is not None and iteration % save_every == 0:
+                    # records of all samples built at once and appended as a shard by the background writer
+                    adv_writer.submit(iteration, self.val_tokens, build_adv_records(self.val_columns, iteration_noise.numpy()))
+        finally:
+            if adv_writer is not None:
+                adv_writer.close()
+
+        if export_legacy and adv_writer is not None:
+            export_legacy_json(adv_shard_dir, 'RAG/hotflip/adv_injection/all_2000.json')
+            export_legacy_json(adv_shard_dir, 'RAG/hotflip/adv_injection/memory_cluster_100_5000_adv_instance_10.json')
+
+        # plot loss curve
+        plt.figure(figsize=(10, 6))
+        plt.plot(loss_list)
+        plt.title('Loss curve for optimizing noise on ego-states')
+        plt.xlabel('Iteration')
+        plt.ylabel('Loss')
+        plt.grid(True)
+        plt.savefig(f"{root_dir}/loss_curve.png")
+        plt.close()
+
+        final_losses = population_loss(population_stats, noise_vectors.detach())
+        return {
+            "noise_vector": noise_vectors[final_losses.argmin()].detach().cpu(),
+            "noise_vectors": noise_vectors.detach().cpu(),
+            "loss_list": loss_list,
+            "root_dir": root_dir,
+        }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples_path", type=str, default="data/finetune/data_samples_val.json", help="JSON list of validation samples")
+    parser.add_argument("--num_samples", type=int, default=2000, help="Number of validation queries")
+    parser.add_argument("--db_size", type=int, default=20000, help="Number of memory database rows")
+    parser.add_argument("--device", "-d", type=str, default="auto", help="Device ('auto' picks cuda:0 if available, else cpu)")
+    parser.add_argument("--learning_rate", "-lr", type=float, default=0.2, help="Adam learning rate")
+    parser.add_argument("--max_iters", "-n", type=int, default=100, help="Number of Adam iterations")
+    parser.add_argument("--search_mode", type=str, default="none", choices=["none", "grid", "cma"], help="Batched population search that picks the Adam starts (none: random starts)")
+    parser.add_argument("--num_starts", type=int, default=1, help="Number of Adam starts refined together in one batch")
+    parser.add_argument("--plot_every", type=int, default=10, help="Plot the embeddings every N iterations (0 to disable)")
+    parser.add_argument("--save_every", type=int, default=20, help="Save the adversarial records every N iterations (0 to disable)")
+    parser.add_argument("--export_legacy", action="store_true", help="Also write the legacy RAG/hotflip/adv_injection JSON files")
+    parser.add_argument("--memory_storage", type=str, default="float32", choices=MEMORY_STORAGE, help="Storage of the database keys; float16 / int8 / pq are scored asymmetrically on the codes")
+    parser.add_argument("--pq_subspaces", type=int, default=None, help="Number of PQ subspaces (default: one per 8 dimensions)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+    linear_optimizer = LinearEmbedderOptimizer(args.samples_path, args.num_samples, args.db_size, args.device,
+                                               memory_storage=args.memory_storage, pq_subspaces=args.pq_subspaces)
+    result = linear_optimizer.run(learning_rate=args.learning_rate, max_iters=args.max_iters, search_mode=args.search_mode, num_starts=args.num_starts,
+                                  plot_every=args.plot_every, save_every=args.save_every, export_legacy=args.export_legacy)
+
+    # Final optimized noise
+    print("Optimized noise vector:", result["noise_vector"].tolist())
+    print("Results saved to", result["root_dir"])
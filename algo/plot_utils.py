@@ -0,0 +1,109 @@
+import multiprocessing as mp
+import queue
+import numpy as np
+import torch
+from sklearn.decomposition import PCA
+import wandb
+from algo.embedding_store import dense_sample
+
+
+def _to_numpy(embeddings):
+    if isinstance(embeddings, torch.Tensor):
+        embeddings = embeddings.detach().float().cpu().numpy()
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+class PCAProjector:
+    """
+    Fits a 2-D PCA on the database embeddings once and reuses it to project the query embeddings.
+    The database is subsampled to `max_points` both for fitting and for plotting.
+    """
+    def __init__(self, db_embeddings, max_points=5000, seed=0):
+        # compressed memories decode only the sampled rows
+        db_embeddings = _to_numpy(dense_sample(db_embeddings, max_points, seed=seed))
+        self.pca = PCA(n_components=2)
+        self.reduced_db = self.pca.fit_transform(db_embeddings).astype(np.float32)
+
+    def transform(self, query_embeddings):
+        return self.pca.transform(_to_numpy(query_embeddings)).astype(np.float32)
+
+
+def _render_worker(job_queue, result_queue, reduced_db):
+    """
+    Renders the PCA figures in a separate process. The benign scatter is drawn once and only the
+    adversarial points are updated per job.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(10, 8))
+    ax.scatter(reduced_db[:, 0], reduced_db[:, 1], c='grey', alpha=0.5, label='Benign Embeddings', rasterized=True)
+    selected = ax.scatter([], [], c='red', alpha=0.7, label='Adversarial Embeddings')
+    ax.set_xlabel('Principal Component 1')
+    ax.set_ylabel('Principal Component 2')
+    ax.legend()
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        reduced_selected, path, title = job
+        selected.set_offsets(reduced_selected)
+        ax.ignore_existing_data_limits = True
+        ax.update_datalim(reduced_db)
+        ax.update_datalim(reduced_selected)
+        ax.autoscale_view()
+        ax.set_title(f'PCA of Embeddings {title}')
+        fig.savefig(path)
+        result_queue.put(path)
+
+    plt.close(fig)
+
+
+class PCAPlotter:
+    """
+    PCA plots of the adversarial embeddings against the database. The projection is fitted once in
+    the main process; rendering and saving happen in a background worker, and finished figures are
+    handed to wandb (which uploads them from its own process) as they complete.
+    """
+    def __init__(self, db_embeddings, root_dir, max_points=5000, report_to_wandb=False):
+        self.root_dir = root_dir
+        self.report_to_wandb = report_to_wandb
+        self.projector = PCAProjector(db_embeddings, max_points=max_points)
+
+        ctx = mp.get_context("spawn")
+        self.job_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=_render_worker,
+                                   args=(self.job_queue, self.result_queue, self.projector.reduced_db),
+                                   daemon=True)
+        self.process.start()
+        self.pending = 0
+
+    def submit(self, query_embeddings, title):
+        reduced_selected = self.projector.transform(query_embeddings)
+        path = f"{self.root_dir}/pca_generation_{title}.png"
+        self.job_queue.put((reduced_selected, path, title))
+        self.pending += 1
+        self._collect(block=False)
+
+    def _collect(self, block):
+        while self.pending > 0:
+            try:
+                path = self.result_queue.get(block=block, timeout=60 if block else None)
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if self.report_to_wandb:
+                try:
+                    wandb.log({"PCA": wandb.Image(path)})
+                except Exception as e:
+                    print(e)
+                    pass
+
+    def close(self):
+        if self.process.is_alive():
+            self.job_queue.put(None)
+            self._collect(block=True)
+            self.process.join()
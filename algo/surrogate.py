@@ -0,0 +1,104 @@
+import math
+import torch
+import wandb
+
+
+def spearman_correlation(x, y):
+    """Spearman rank correlation of two 1-D tensors."""
+    x_rank = x.argsort().argsort().double()
+    y_rank = y.argsort().argsort().double()
+    x_rank -= x_rank.mean()
+    y_rank -= y_rank.mean()
+    denom = x_rank.norm() * y_rank.norm()
+    if denom == 0:
+        return 0.0
+    return (x_rank @ y_rank / denom).item()
+
+
+class SurrogateRanker:
+    """
+    Online ridge-regression surrogate of the per-batch score gain of a candidate swap. The features are the
+    change of the word embedding at the flipped position and a one-hot of that position. It is refitted in
+    closed form from running sufficient statistics after every iteration, pre-ranks the hotflip pool so
+    that only its top `eval_fraction` gets a real evaluation, and adapts that fraction to its measured
+    rank correlation with the real scores.
+    """
+    def __init__(self, embedding_matrix, num_positions, ridge=1.0, min_samples=200, min_fraction=0.1,
+                 low_correlation=0.3, high_correlation=0.6):
+        self.embedding_matrix = embedding_matrix
+        self.num_positions = num_positions
+        self.min_samples = min_samples
+        self.min_fraction = min_fraction
+        self.low_correlation = low_correlation
+        self.high_correlation = high_correlation
+
+        dim = embedding_matrix.shape[1] + num_positions + 1
+        self._xtx = ridge * torch.eye(dim, dtype=torch.float64)
+        self._xty = torch.zeros(dim, dtype=torch.float64)
+        self._weights = torch.zeros(dim, dtype=torch.float64)
+        self.num_samples = 0
+        self.eval_fraction = 1.0
+        self.correlation = None
+
+    def features(self, adv_passage_ids, candidates, candidate_positions):
+        with torch.no_grad():
+            old_embeddings = self.embedding_matrix[adv_passage_ids[candidate_positions]]
+            new_embeddings = self.embedding_matrix[candidates]
+            position_one_hot = torch.nn.functional.one_hot(candidate_positions, self.num_positions)
+            bias = torch.ones((len(candidates), 1), device=candidates.device)
+            features = torch.cat((new_embeddings - old_embeddings, position_one_hot, bias), dim=1)
+        return features.double().cpu()
+
+    def predict(self, features):
+        return features @ self._weights
+
+    def select(self, features):
+        """Returns the indices of the candidates that should get a real evaluation."""
+        if self.num_samples < self.min_samples or self.eval_fraction >= 1.0:
+            return torch.arange(len(features))
+        num_keep = max(1, math.ceil(len(features) * self.eval_fraction))
+        return self.predict(features).topk(num_keep).indices
+
+    def update(self, features, gains):
+        gains = gains.double().cpu()
+        if self.num_samples >= self.min_samples and len(gains) >= 3:
+            self.correlation = spearman_correlation(self.predict(features), gains)
+            # trust the surrogate more when it ranks well, fall back to real evaluations when it does not
+            if self.correlation > self.high_correlation:
+                self.eval_fraction = max(self.min_fraction, self.eval_fraction * 0.8)
+            elif self.correlation < self.low_correlation:
+                self.eval_fraction = min(1.0, self.eval_fraction * 1.25)
+            try:
+                wandb.log({
+                    "Surrogate Spearman": self.correlation,
+                    "Surrogate eval fraction": self.eval_fraction,
+                })
+            except Exception as e:
+                print(e)
+                pass
+        elif self.num_samples + len(gains) >= self.min_samples:
+            # start pre-ranking below full evaluation once enough pairs are seen
+            self.eval_fraction = 0.5
+
+        self._xtx += features.T @ features
+        self._xty += features.T @ gains
+        self._weights = torch.linalg.solve(self._xtx, self._xty)
+        self.num_samples += len(gains)
+
+    def state_dict(self):
+        return {
+            "xtx": self._xtx.clone(),
+            "xty": self._xty.clone(),
+            "weights": self._weights.clone(),
+            "num_samples": self.num_samples,
+            "eval_fraction": self.eval_fraction,
+            "correlation": self.correlation,
+        }
+
+    def load_state_dict(self, state):
+        self._xtx = state["xtx"].clone()
+        self._xty = state["xty"].clone()
+        self._weights = state["weights"].clone()
+        self.num_samples = state["num_samples"]
+        self.eval_fraction = state["eval_fraction"]
+        self.correlation = state["correlation"]
@@ -2,23 +2,60 @@ from torch.utils.data import DataLoader
 import torch
 from tqdm import tqdm
 import random
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
-from sklearn.mixture import GaussianMixture
 import datetime
 import argparse
+import math
+from collections import OrderedDict, deque
 import sys
 import os
+import queue
+import traceback
 sys.path.append("./")
 from algo.utils import (
     load_models, 
     load_db_ad, 
+    load_gmm_centers,
+    memmap_db_embeddings,
+    build_query_cache,
+    materialize_batch,
     get_embeddings, 
     AgentDriverDataset, 
     bert_get_adv_emb,
+    bert_get_adv_emb_batched,
+    bert_get_adv_emb_stacked,
     target_word_prob,
     target_asr)
+from algo.plot_utils import PCAPlotter
+from algo.embedding_store import MEMORY_STORAGE, CompressedEmbeddings, dense_sample, load_compressed_embeddings
+from algo.export_utils import EXPORT_BACKENDS, load_exported_retriever, load_quantized_retriever
+from algo.vocab_utils import (
+    VOCAB_RULES,
+    load_admissible_token_ids,
+    admissible_embedding_matrix,
+    load_knn_graph,
+    knn_candidates)
+from algo.surrogate import SurrogateRanker, spearman_correlation
+from algo.device_utils import (
+    resolve_device,
+    default_forward_batch_size,
+    configure_cpu_threads,
+    scoring_autocast,
+    worker_context,
+    worker_resources)
+from algo.dist_utils import (
+    get_rank,
+    get_world_size,
+    all_reduce_sum,
+    shard_indices,
+    find_free_port,
+    init_gloo)
+from algo.checkpoint import (
+    get_rng_state,
+    set_rng_state,
+    save_checkpoint,
+    find_latest_checkpoint,
+    load_checkpoint)
 
 import gc
 from agentdriver.reasoning.prompt_reasoning import *
@@ -27,6 +64,19 @@ import sys
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# used when --checkpoint_every is not given; beam search does not checkpoint
+DEFAULT_CHECKPOINT_EVERY = 10
+
+# arguments that change the optimization trajectory and must match the checkpoint on --resume
+RESUME_ARGS = (
+    "agent", "algo", "model", "num_grad_iter", "per_gpu_eval_batch_size", "num_cand", "num_adv_passage_tokens",
+    "multi_position", "export_retriever", "quantized_scoring", "rescore_top", "bf16_scoring", "successive_halving",
+    "halving_keep", "vocab_filter", "vocab_rules", "knn_k", "knn_pool", "knn_switch_iter", "tabu_size", "surrogate",
+    "surrogate_min_samples", "surrogate_min_fraction", "adaptive_cand", "min_cand", "max_cand", "acceptance_window",
+    "early_stop_patience", "plateau_tol", "data_parallel", "golden_trigger", "target_gradient_guidance", "use_gpt",
+    "memory_storage", "pq_subspaces", "ppl_filter", "asr_threshold", "lambda_weight", "seed",
+)
+
 # fitness score
 def gaussian_kernel_matrix(x, y, sigma):
     """
@@ -41,6 +91,9 @@ def maximum_mean_discrepancy(x, y, sigma=1.0):
     Computes the Maximum Mean Discrepancy (MMD) between two samples, `x` and `y`
     using a Gaussian kernel for feature space mapping.
     """
+    if isinstance(y, CompressedEmbeddings):
+        # asymmetric: the memory side is scored on its codes
+        return torch.mean(gaussian_kernel_matrix(x, x, sigma)) + y.mean_self_kernel(sigma) - 2 * y.mean_kernel(x, sigma)
     x_kernel = gaussian_kernel_matrix(x, x, sigma)
     y_kernel = gaussian_kernel_matrix(y, y, sigma)
     xy_kernel = gaussian_kernel_matrix(x, y, sigma)
@@ -73,12 +126,13 @@ def compute_fitness(query_embedding, db_embeddings):
     # print("variance", variance)
     return 40 * mmd - 0.02 * variance, mmd, variance  # Note that we subtract variance because we want to minimize it
 
-def compute_avg_cluster_distance(query_embedding, cluster_centers):
+def compute_avg_cluster_distance(query_embedding, cluster_centers, lambda_weight=0.1):
     """
     Compute the average distance of the query embedding to the gaussian mixture cluster centroids of the database embeddings.
     Args:
         query_embedding (Tensor): The query embedding tensor.
         cluster_centers (Tensor): The cluster centers tensor.
+        lambda_weight (float): Weight of the compactness loss.
     Returns:
         float: The combined loss score.
     """
@@ -98,7 +152,6 @@ def compute_avg_cluster_distance(query_embedding, cluster_centers):
     
     # Combined objective function - negative because we want to maximize distance
     # and minimize variance
-    lambda_weight = 0.1
     score = overall_avg_distance - lambda_weight * variance
     
         # Log the losses to wandb
@@ -114,6 +167,140 @@ def compute_avg_cluster_distance(query_embedding, cluster_centers):
     
     return score
 
+def compute_avg_cluster_distance_batched(query_embeddings, cluster_centers, lambda_weight=0.1):
+    """
+    Batched version of `compute_avg_cluster_distance` for the candidate evaluation (no wandb logging).
+    Args:
+        query_embeddings (Tensor): (C, B, D) query embeddings of C candidate triggers.
+        cluster_centers (Tensor): The cluster centers tensor.
+        lambda_weight (float): Weight of the compactness loss.
+    Returns:
+        Tensor: (C,) combined score per candidate.
+    """
+    cluster_centers = cluster_centers.reshape(-1, cluster_centers.shape[-1])
+    query_embeddings = query_embeddings.to(cluster_centers.dtype)
+    num_candidates = query_embeddings.shape[0]
+
+    # L_uni (Uniqueness Loss) - Eq. 7
+    distances = torch.cdist(query_embeddings, cluster_centers.expand(num_candidates, -1, -1), compute_mode='donot_use_mm_for_euclid_dist')
+    overall_avg_distance = distances.mean(dim=2).mean(dim=1)
+
+    # L_cpt (Compactness Loss) - Eq. 8
+    mean_embedding = query_embeddings.mean(dim=1, keepdim=True)
+    variance = torch.norm(query_embeddings - mean_embedding, dim=2).mean(dim=1)
+
+    return overall_avg_distance - lambda_weight * variance
+
+def score_candidate_batch(args, resources, data, candidate_passage_ids, exact=False):
+    """
+    Scores every trigger row of `candidate_passage_ids` on one data batch. Returns a (C,) float64 tensor.
+    Unless `exact` is set, the int8 pre-screening retriever is used when one is loaded.
+    """
+    if args.agent == "ad":
+        # forward-only, so it may run under bfloat16 autocast; the distances are computed in the centers' dtype
+        with scoring_autocast(resources["device"], args.bf16_scoring):
+            scoring_model = None if exact else resources.get("quantized_model")
+            if scoring_model is None:
+                scoring_model = resources.get("scoring_model")
+            if scoring_model is None:
+                scoring_model = resources["model"]
+            candidate_query_embeddings = bert_get_adv_emb_batched(data, scoring_model, args.num_adv_passage_tokens, candidate_passage_ids,
+                                                                  resources["query_cache"], resources["tokenizer"].pad_token_id,
+                                                                  resources["device"], args.forward_batch_size)
+
+    with torch.no_grad():
+        if args.algo == "ap":
+            can_loss = compute_avg_cluster_distance_batched(candidate_query_embeddings, resources["cluster_centers"], args.lambda_weight)
+
+    return can_loss.double()
+
+def score_candidates(args, resources, batch, candidate_passage_ids, score_cache=None, exact=False):
+    """
+    Scores trigger rows on one `(batch_idx, data)` batch. With a `score_cache`, rows already scored on
+    that batch are served from the cache and only the new ones are run through the retriever.
+    Under data parallelism every worker scores its round-robin share of the rows and the score
+    vectors are all-reduced, so all workers return the full vector.
+    """
+    batch_idx, data = batch
+    if get_world_size() > 1:
+        own_rows = shard_indices(len(candidate_passage_ids))
+        scores = torch.zeros(len(candidate_passage_ids), dtype=torch.float64, device=resources["device"])
+        if len(own_rows) > 0:
+            own_passage_ids = candidate_passage_ids[own_rows.to(candidate_passage_ids.device)]
+            if score_cache is None:
+                scores[own_rows] = score_candidate_batch(args, resources, data, own_passage_ids, exact)
+            else:
+                scores[own_rows] = score_cache.score(batch_idx, own_passage_ids,
+                                                     lambda rows: score_candidate_batch(args, resources, data, rows)).to(resources["device"])
+        return all_reduce_sum(scores)
+    if score_cache is None:
+        return score_candidate_batch(args, resources, data, candidate_passage_ids, exact)
+    return score_cache.score(batch_idx, candidate_passage_ids,
+                             lambda rows: score_candidate_batch(args, resources, data, rows)).to(resources["device"])
+
+def score_exact(args, resources, batches, passage_ids):
+    """
+    Sums the full-precision scores of the rows of `passage_ids` over `(batch_idx, data)` batches, bypassing
+    the int8 pre-screening retriever and the score cache.
+    """
+    scores = torch.zeros(passage_ids.shape[0], dtype=torch.float64, device=resources["device"])
+    for batch in batches:
+        scores += score_candidates(args, resources, batch, passage_ids, exact=True)
+    return scores
+
+def report_quantized_agreement(args, resources, batches, passage_ids, scores):
+    """
+    Re-scores every scored row of the pool (finite `scores`) with the full-precision retriever and reports
+    the Spearman correlation and the top-1 agreement between the int8 and the exact ranking of the pool.
+    """
+    scored = torch.where(torch.isfinite(scores))[0]
+    if len(scored) < 3:
+        return
+    quantized_scores = scores[scored].cpu()
+    exact_scores = score_exact(args, resources, batches, passage_ids[scored.to(passage_ids.device)]).cpu()
+    rank_agreement = spearman_correlation(quantized_scores, exact_scores)
+    top1_agreement = bool(quantized_scores.argmax() == exact_scores.argmax())
+    print(f"Quantized pre-screening: Spearman {rank_agreement:.3f} over {len(scored)} triggers, top-1 {'agrees' if top1_agreement else 'differs'}")
+    try:
+        wandb.log({"Quantized rank agreement": rank_agreement, "Quantized top-1 agreement": float(top1_agreement)})
+    except Exception as e:
+        print(e)
+        pass
+
+def successive_halving(score_fn, num_candidates, data_iter, num_batches, keep_fraction=0.5):
+    """
+    Successive-halving evaluation of a candidate pool whose index 0 is the incumbent trigger.
+    All candidates are scored on the first batch; after every round only the top `keep_fraction`
+    challengers survive and the cumulative depth doubles, until one challenger remains or the
+    `num_batches` budget is spent. The incumbent is never pruned, so the survivors are compared
+    against it on exactly the same batches.
+    Args:
+        score_fn (callable): `score_fn(data, candidate_idx)` returns the scores of the given candidates on one batch.
+    Returns:
+        (Tensor, int): Cumulative scores (-inf for pruned candidates) and the number of batches scored.
+    """
+    scores = torch.zeros(num_candidates, dtype=torch.float64)
+    alive = torch.arange(num_candidates)
+    num_scored = 0
+    round_batches = 1
+    while num_scored < num_batches:
+        for _ in range(min(round_batches, num_batches - num_scored)):
+            data = next(data_iter)
+            scores[alive] += score_fn(data, alive).cpu()
+            num_scored += 1
+        challengers = alive[1:]
+        if num_scored >= num_batches or len(challengers) <= 1:
+            break
+        num_keep = max(1, math.ceil(len(challengers) * keep_fraction))
+        challengers = challengers[scores[challengers].topk(num_keep).indices]
+        alive = torch.cat((alive[:1], challengers))
+        round_batches = num_scored
+
+    final_scores = torch.full((num_candidates,), float('-inf'), dtype=torch.float64)
+    final_scores[alive] = scores[alive]
+
+    return final_scores, num_scored
+
 def compute_avg_embedding_similarity(query_embedding, db_embeddings):
     """
     Compute the average cosine similarity of the query embedding to each db_embeddings.
@@ -129,7 +316,10 @@ def compute_avg_embedding_similarity(query_embedding, db_embeddings):
     # db_embeddings torch.Size([20000, 768])
 
     # Calculate the cosine similarity between each pair of query and db embeddings
-    similarities = torch.mm(query_embedding, db_embeddings.T)
+    if isinstance(db_embeddings, CompressedEmbeddings):
+        similarities = db_embeddings.inner_products(query_embedding)
+    else:
+        similarities = torch.mm(query_embedding, db_embeddings.T)
     
     # similarities = torch.mm(expanded_query_embeddings, db_embeddings.T)
     # Calculate the average similarity from each query to the db embeddings
@@ -141,29 +331,180 @@ def compute_avg_embedding_similarity(query_embedding, db_embeddings):
     return overall_avg_similarity
 
 
+class CandidateScoreCache:
+    """
+    Bounded LRU cache of candidate scores keyed by (trigger ids, batch index). Only valid when the
+    evaluation batches are fixed for the whole run.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def score(self, batch_idx, candidate_passage_ids, score_fn):
+        """Returns the scores of all rows, calling `score_fn(rows)` only for rows not cached for `batch_idx`."""
+        scores = torch.empty(candidate_passage_ids.shape[0], dtype=torch.float64)
+        keys = [(tuple(ids), batch_idx) for ids in candidate_passage_ids.tolist()]
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self._scores:
+                self._scores.move_to_end(key)
+                scores[i] = self._scores[key]
+                self.hits += 1
+            else:
+                missing.append(i)
+        if len(missing) > 0:
+            self.misses += len(missing)
+            new_scores = score_fn(candidate_passage_ids[missing]).cpu()
+            for i, score in zip(missing, new_scores.tolist()):
+                scores[i] = score
+                self._scores[keys[i]] = score
+            while len(self._scores) > self.max_size:
+                self._scores.popitem(last=False)
+        return scores
+
+
+class TabuList:
+    """
+    FIFO set of recently rejected (position, token) swaps, masked out of the hotflip ranking.
+    """
+    def __init__(self, max_size):
+        self._queue = deque()
+        self._set = set()
+        self.max_size = max_size
+
+    def add(self, position, token):
+        if (position, token) in self._set:
+            return
+        self._queue.append((position, token))
+        self._set.add((position, token))
+        while len(self._queue) > self.max_size:
+            self._set.discard(self._queue.popleft())
+
+    def filter(self, num_positions, vocab_size, device):
+        """Returns a (T, V) tensor that is +inf at tabu swaps, to be passed as hotflip `filter`."""
+        tabu_filter = torch.zeros((num_positions, vocab_size), device=device)
+        if len(self._queue) > 0:
+            positions, tokens = zip(*self._queue)
+            tabu_filter[list(positions), list(tokens)] = float('inf')
+        return tabu_filter
+
+    def state_dict(self):
+        return {"queue": list(self._queue)}
+
+    def load_state_dict(self, state):
+        self._queue = deque(tuple(swap) for swap in state["queue"])
+        self._set = set(self._queue)
+
+
+class CandidateScheduler:
+    """
+    Adapts the candidate pool size to the acceptance rate of the last `window` iterations and decides
+    when the search has converged. A high acceptance rate shrinks the pool (cheap iterations still find
+    improvements), a low one grows it (search wider before giving up). The run stops once no swap was
+    accepted for `patience` iterations, or once the best score gained less than `plateau_tol` (relative)
+    over the last `window` iterations.
+    """
+    def __init__(self, num_cand, min_cand, max_cand, adaptive=False, window=10, patience=0, plateau_tol=0.0):
+        self.num_cand = num_cand
+        self.min_cand = min_cand
+        self.max_cand = max_cand
+        self.adaptive = adaptive
+        self.window = window
+        self.patience = patience
+        self.plateau_tol = plateau_tol
+        self._accepted = deque(maxlen=window)
+        self._best_scores = deque(maxlen=window + 1)
+        self.since_improvement = 0
+        self.stop_reason = None
+
+    @property
+    def acceptance_rate(self):
+        return sum(self._accepted) / len(self._accepted) if len(self._accepted) > 0 else 0.0
+
+    def update(self, improved, best_score):
+        self._accepted.append(improved)
+        self._best_scores.append(best_score)
+        self.since_improvement = 0 if improved else self.since_improvement + 1
+
+        if self.adaptive and len(self._accepted) == self.window:
+            if self.acceptance_rate > 0.5:
+                self.num_cand = max(self.min_cand, int(self.num_cand * 0.8))
+            elif self.acceptance_rate < 0.1:
+                self.num_cand = min(self.max_cand, int(math.ceil(self.num_cand * 1.5)))
+
+        if self.patience > 0 and self.since_improvement >= self.patience:
+            self.stop_reason = f"no accepted swap in {self.since_improvement} iterations"
+        elif self.plateau_tol > 0 and len(self._best_scores) == self.window + 1 and math.isfinite(self._best_scores[0]):
+            gain = (self._best_scores[-1] - self._best_scores[0]) / max(abs(self._best_scores[0]), 1e-12)
+            # a wider pool gets a chance before a plateau counts as convergence
+            if gain < self.plateau_tol and (not self.adaptive or self.num_cand >= self.max_cand):
+                self.stop_reason = f"best score gained {gain:.2e} over {self.window} iterations"
+        return self.stop_reason
+
+    def state_dict(self):
+        return {
+            "num_cand": self.num_cand,
+            "accepted": list(self._accepted),
+            "best_scores": list(self._best_scores),
+            "since_improvement": self.since_improvement,
+        }
+
+    def load_state_dict(self, state):
+        self.num_cand = state["num_cand"]
+        self._accepted.extend(state["accepted"])
+        self._best_scores.extend(state["best_scores"])
+        self.since_improvement = state["since_improvement"]
+
+
 class GradientStorage:
     """
-    This object stores the intermediate gradients of the output a the given PyTorch module, which
-    otherwise might not be retained.
+    This object accumulates the gradients of the output of the given PyTorch module at the trigger
+    positions, which otherwise might not be retained. The (T, D) buffer is allocated once per run and
+    every backward adds its trigger-position gradients into it in place; `reset` clears it at the start
+    of each gradient pass and `detach` / `attach` switch the hook off and on around forward-only scoring.
+    With `num_rows`, the batch rows are not summed: row b of every backward is added to a separate
+    (T, D) slice of a (num_rows, T, D) buffer, so that stacked triggers get their own gradients.
     """
-    def __init__(self, module, num_adv_passage_tokens):
-        self._stored_gradient = None
+    def __init__(self, module, num_adv_passage_tokens, num_rows=None):
+        self.module = module
         self.num_adv_passage_tokens = num_adv_passage_tokens
-        module.register_full_backward_hook(self.hook)
+        self.num_rows = num_rows
+        weight = module.weight
+        shape = (num_adv_passage_tokens, weight.shape[1]) if num_rows is None else (num_rows, num_adv_passage_tokens, weight.shape[1])
+        self._stored_gradient = torch.zeros(shape, dtype=weight.dtype, device=weight.device)
+        self._handle = None
+        self.attach()
 
     # def hook(self, module, grad_in, grad_out):
     #     self._stored_gradient = grad_out[0]
     def hook(self, module, grad_in, grad_out):
-        if self._stored_gradient is None:
-            # self._stored_gradient = grad_out[0][:, -num_adv_passage_tokens:]
-            self._stored_gradient = grad_out[0][:, -self.num_adv_passage_tokens:]
+        trigger_grad = grad_out[0][:, -self.num_adv_passage_tokens:]
+        if self.num_rows is None:
+            # (B, L, D) -> sum over the batch of the last T positions
+            self._stored_gradient.add_(trigger_grad.sum(dim=0))
         else:
-            # self._stored_gradient += grad_out[0]  # This is a simple accumulation example
-            self._stored_gradient += grad_out[0][:, -self.num_adv_passage_tokens:]
+            self._stored_gradient[:len(trigger_grad)].add_(trigger_grad)
 
     def get(self):
         return self._stored_gradient
 
+    def reset(self):
+        self._stored_gradient.zero_()
+
+    def attach(self):
+        if self._handle is None:
+            self._handle = self.module.register_full_backward_hook(self.hook)
+
+    def detach(self):
+        if self._handle is not None:
+            self._handle.remove()
+            self._handle = None
+
+    def remove(self):
+        self.detach()
+
 
 def compute_perplexity(input_ids, model, device):
     """
@@ -191,8 +532,14 @@ def hotflip_attack(averaged_grad,
                    increase_loss=False,
                    num_candidates=1,
                    filter=None,
-                   slice=None):
-    """Returns the top candidate replacements."""
+                   slice=None,
+                   admissible_ids=None,
+                   current_token=None):
+    """
+    Returns the top candidate replacements. With `admissible_ids`, `embedding_matrix` holds only those rows,
+    `filter` is still indexed by the full vocabulary, and the returned ids are mapped back to vocabulary ids.
+    `current_token`, the token at the flipped position, is excluded so that the pool holds no no-op swap.
+    """
 
     # print("averaged_grad", averaged_grad[0:50])
     # print("embedding_matrix", embedding_matrix[0:50])
@@ -204,7 +551,7 @@ def hotflip_attack(averaged_grad,
             averaged_grad
         )
         if filter is not None:
-            gradient_dot_embedding_matrix -= filter
+            gradient_dot_embedding_matrix -= filter if admissible_ids is None else filter[admissible_ids]
         if not increase_loss:
             gradient_dot_embedding_matrix *= -1
         # _, top_k_ids = gradient_dot_embedding_matrix.topk(num_candidates)
@@ -214,7 +561,15 @@ def hotflip_attack(averaged_grad,
 
         # Exclude tokens from 0 to slice (including slice)
         if slice is not None:
-            mask[:slice + 1] = True
+            if admissible_ids is None:
+                mask[:slice + 1] = True
+            else:
+                mask |= admissible_ids <= slice
+        if current_token is not None:
+            if admissible_ids is None:
+                mask[current_token] = True
+            else:
+                mask |= admissible_ids == current_token
 
         # Apply mask: set masked positions to -inf if finding top k or inf if finding bottom k
         limit_value = float('-inf') if increase_loss else float('inf')
@@ -224,35 +579,99 @@ def hotflip_attack(averaged_grad,
 
         # Get the top k indices from the filtered matrix
         _, top_k_ids = gradient_dot_embedding_matrix.topk(num_candidates)
+        if admissible_ids is not None:
+            top_k_ids = admissible_ids[top_k_ids]
 
     return top_k_ids
 
+def hotflip_attack_multi(averaged_grad,
+                         embedding_matrix,
+                         adv_passage_ids,
+                         num_candidates=1,
+                         filter=None,
+                         slice=None,
+                         admissible_ids=None):
+    """
+    Ranks the swaps at every trigger position with a single matmul and samples a candidate pool
+    mixing positions from the per-position top-k (k = num_candidates).
+    Args:
+        averaged_grad (Tensor): (T, D) gradient at every trigger position.
+        embedding_matrix (Tensor): (V, D) word embedding matrix.
+        adv_passage_ids (Tensor): (T,) current trigger ids; swapping a token for itself is excluded.
+        num_candidates (int): Size of the sampled pool.
+        filter (Tensor): Optional (T, V) tensor subtracted from the ranking.
+        admissible_ids (Tensor): Optional vocabulary ids of the rows of `embedding_matrix`.
+    Returns:
+        (Tensor, Tensor): Candidate token ids and the position each one replaces.
+    """
+    with torch.no_grad():
+        # (V, D) @ (D, T) -> (T, V)
+        gradient_dot_embedding_matrix = torch.matmul(embedding_matrix, averaged_grad.T).T
+        if admissible_ids is None:
+            admissible_ids = torch.arange(embedding_matrix.shape[0], device=embedding_matrix.device)
+        if filter is not None:
+            gradient_dot_embedding_matrix -= filter[:, admissible_ids]
+
+        mask = admissible_ids.unsqueeze(0) == adv_passage_ids.unsqueeze(1)
+        if slice is not None:
+            mask |= admissible_ids.unsqueeze(0) <= slice
+        gradient_dot_embedding_matrix.masked_fill_(mask, float('-inf'))
+
+        _, top_k_ids = gradient_dot_embedding_matrix.topk(num_candidates, dim=1)
+        top_k_ids = admissible_ids[top_k_ids]
+
+        # sample uniformly from the (position, token) pool
+        pool_ids = torch.randperm(top_k_ids.numel())[:num_candidates].to(top_k_ids.device)
+        candidate_positions = pool_ids // num_candidates
+        candidates = top_k_ids.view(-1)[pool_ids]
+
+    return candidates, candidate_positions
+
 def candidate_filter(candidates,
             num_candidates=1,
             token_to_flip=None,
             adv_passage_ids=None,
-            ppl_model=None):
-    """Returns the top candidate with max ppl."""
+            ppl_model=None,
+            device='cuda'):
+    """
+    Returns the top candidate with max ppl. `token_to_flip` is either one position shared by all candidates,
+    or a tensor with the position of every candidate, in which case the kept positions are returned as well.
+    """
     with torch.no_grad():
     
         ppl_scores = []
-        temp_adv_passage = adv_passage_ids.clone()
-        for candidate in candidates:
-            temp_adv_passage[:, token_to_flip] = candidate
+        for i, candidate in enumerate(candidates):
+            temp_adv_passage = adv_passage_ids.clone()
+            position = token_to_flip[i] if isinstance(token_to_flip, torch.Tensor) else token_to_flip
+            temp_adv_passage[:, position] = candidate
             ppl_score = compute_perplexity(temp_adv_passage, ppl_model, device) * -1
             ppl_scores.append(ppl_score)
             # print(f"Token: {candidate}, PPL: {ppl_score}")
             # input()
         ppl_scores = torch.tensor(ppl_scores)
-        _, top_k_ids = ppl_scores.topk(num_candidates)
+        _, top_k_ids = ppl_scores.topk(min(num_candidates, len(ppl_scores)))
+        top_k_ids = top_k_ids.to(candidates.device)
         candidates = candidates[top_k_ids]
 
+    if isinstance(token_to_flip, torch.Tensor):
+        return candidates, token_to_flip[top_k_ids]
     return candidates
 
-def evaluate_property(query_samples, db_embeddings, n_clusters=5, model=None, tokenizer=None, plot=False):
+def merge_candidate_pools(candidates, candidate_positions, vocab_size):
+    """Drops repeated (position, token) swaps from concatenated candidate pools, keeping the first occurrence."""
+    seen = set()
+    keep = []
+    for i, key in enumerate((candidate_positions * vocab_size + candidates).tolist()):
+        if key not in seen:
+            seen.add(key)
+            keep.append(i)
+    keep = torch.tensor(keep, device=candidates.device)
+    return candidates[keep], candidate_positions[keep]
+
+def evaluate_property(query_samples, db_embeddings, n_clusters=5, model=None, tokenizer=None, plot=False, root_dir="."):
 
     # Cluster the rest of the database embeddings
-    kmeans = KMeans(n_clusters=n_clusters, random_state=0).fit(db_embeddings.cpu().detach().numpy())
+    kmeans = KMeans(n_clusters=n_clusters, random_state=0).fit(dense_sample(db_embeddings, 100000).cpu().detach().numpy())
     cluster_centers = kmeans.cluster_centers_
 
     query_embeddings = get_emb(model, query_samples, tokenizer)
@@ -269,38 +688,12 @@ def evaluate_property(query_samples, db_embeddings, n_clusters=5, model=None, to
     mmd = maximum_mean_discrepancy(query_embeddings, db_embeddings)
 
     if plot:
-        plot_PCA(query_embeddings, db_embeddings, root_dir)
+        pca_plotter = PCAPlotter(db_embeddings, root_dir)
+        pca_plotter.submit(query_embeddings, title="evaluation")
+        pca_plotter.close()
 
     return average_distances, min_distance, variance, mmd
 
-def plot_PCA(query_embeddings, db_embeddings, root_dir, title):
-
-    # Perform PCA on the selected embeddings along with db_embeddings for visualization
-    pca = PCA(n_components=2)
-    all_embeddings = torch.vstack((query_embeddings, db_embeddings))
-    reduced_embeddings = pca.fit_transform(all_embeddings.cpu().detach().numpy())
-
-    # Separate the reduced embeddings back into selected and db groups
-    reduced_selected = reduced_embeddings[:len(query_embeddings)]
-    reduced_db = reduced_embeddings[len(query_embeddings):]
-
-    # Plot PCA of the embeddings
-    plt.figure(figsize=(10, 8))
-    plt.scatter(reduced_db[:, 0], reduced_db[:, 1], c='grey', alpha=0.5, label='Benign Embeddings')
-    plt.scatter(reduced_selected[:, 0], reduced_selected[:, 1], c='red', alpha=0.7, label='Adversarial Embeddings')
-    plt.title(f'PCA of Embeddings {title}')
-    plt.xlabel('Principal Component 1')
-    plt.ylabel('Principal Component 2')
-    plt.legend()
-    plt.savefig(f"{root_dir}/pca_generation_{title}.png")
-
-    # also log the image to wandb
-    try:
-        wandb.log({"PCA": wandb.Image(plt)})
-    except Exception as e:
-        print(e)
-        pass
-    
 def trigger_insertion(trigger_token_list, CoT_exmaple_set, prefix=""):
     """
     Insert the trigger tokens into the CoT examples
@@ -321,8 +714,7 @@ def trigger_insertion(trigger_token_list, CoT_exmaple_set, prefix=""):
 
 
 
-if __name__ == "__main__":
-
+def build_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--agent", "-a", type=str, default="ad", help="Agent to red-team")
     parser.add_argument("--algo", "-al", type=str, default="ap", help="Which trigger optimization algorithm to use")
@@ -333,53 +725,150 @@ if __name__ == "__main__":
     parser.add_argument("--per_gpu_eval_batch_size", "-b", type=int, default=64, help="Batch size for trigger optimization")
     parser.add_argument("--num_cand", "-c", default=100, type=int, help="Number of discrete tokens sampled per optimization")
     parser.add_argument("--num_adv_passage_tokens", "-t", type=int, default=10, help="Number of tokens in the trigger sequence")
+    parser.add_argument("--multi_position", "-mp", action="store_true", help="Sample candidate swaps across all trigger positions instead of one random position")
+    parser.add_argument("--forward_batch_size", type=int, default=None, help="Number of [query; trigger] sequences per retriever forward when scoring candidates (default 8 on CPU, 64 on GPU)")
+    parser.add_argument("--export_retriever", type=str, default=None, choices=EXPORT_BACKENDS, help="Exported retriever for database encoding and candidate scoring, cached per model code and validated against eager")
+    parser.add_argument("--quantized_scoring", action="store_true", help="Pre-screen candidates with a dynamically int8-quantized retriever (CPU)")
+    parser.add_argument("--rescore_top", type=int, default=5, help="Candidates re-scored with the full-precision retriever after int8 pre-screening, together with the incumbent (0 to accept on int8 scores)")
+    parser.add_argument("--agreement_every", type=int, default=10, help="Re-score the whole candidate pool in full precision every N iterations to report the int8 ranking agreement (0 to disable)")
+    parser.add_argument("--bf16_scoring", action="store_true", help="Run the forward-only candidate scoring under bfloat16 autocast")
+    parser.add_argument("--successive_halving", "-sh", action="store_true", help="Prune losing candidates early with successive halving over the evaluation batches")
+    parser.add_argument("--halving_keep", type=float, default=0.5, help="Fraction of candidates kept after each successive-halving round")
+    parser.add_argument("--score_cache_size", type=int, default=0, help="Size of the LRU cache of candidate scores; enables fixed evaluation batches (0 to disable)")
+    parser.add_argument("--vocab_filter", "-vf", action="store_true", help="Restrict hotflip candidates to an admissible vocabulary subset")
+    parser.add_argument("--vocab_rules", type=str, nargs="+", default=VOCAB_RULES, choices=VOCAB_RULES, help="Rules defining the admissible vocabulary")
+    parser.add_argument("--knn_k", type=int, default=0, help="Neighbours per token in the word-embedding kNN graph used as a candidate source (0 to disable)")
+    parser.add_argument("--knn_pool", type=int, default=20, help="Number of neighbourhood candidates proposed per iteration")
+    parser.add_argument("--knn_switch_iter", type=int, default=-1, help="Iteration from which only neighbourhood candidates are scored (-1 to always add them to the hotflip pool)")
+    parser.add_argument("--tabu_size", type=int, default=0, help="Number of recently rejected swaps masked out of the hotflip ranking (0 to disable)")
+    parser.add_argument("--surrogate", action="store_true", help="Pre-rank candidates with an online surrogate and only evaluate its top slice")
+    parser.add_argument("--surrogate_min_samples", type=int, default=200, help="Scored candidates seen before the surrogate starts pruning")
+    parser.add_argument("--surrogate_min_fraction", type=float, default=0.1, help="Lowest fraction of the candidate pool that is really evaluated")
+    parser.add_argument("--adaptive_cand", action="store_true", help="Grow or shrink the candidate pool with the recent acceptance rate")
+    parser.add_argument("--min_cand", type=int, default=16, help="Smallest candidate pool of --adaptive_cand")
+    parser.add_argument("--max_cand", type=int, default=None, help="Largest candidate pool of --adaptive_cand (default 4 x num_cand)")
+    parser.add_argument("--acceptance_window", type=int, default=10, help="Iterations over which the acceptance rate and plateau are measured")
+    parser.add_argument("--early_stop_patience", type=int, default=0, help="Stop after this many iterations without an accepted swap (0 to disable)")
+    parser.add_argument("--plateau_tol", type=float, default=0.0, help="Stop when the best score gains less than this (relative) over the acceptance window (0 to disable)")
+    parser.add_argument("--data_parallel", "-dp", type=int, default=1, help="Number of CPU worker processes that split gradient accumulation and candidate scoring")
+    parser.add_argument("--beam_width", "-bw", type=int, default=1, help="Number of trigger sequences kept by beam search (1 for the greedy search)")
+    parser.add_argument("--beam_cands", type=int, default=50, help="Hotflip expansions per beam in beam search")
     parser.add_argument("--golden_trigger", "-gt", action="store_true", help="Whether to start with the golden trigger")
     parser.add_argument("--target_gradient_guidance", "-gg", action="store_true", help="Whether to guide the token update with target model loss")
     parser.add_argument("--use_gpt", "-u", action="store_true", help="Whether to use GPT-3.5 for target gradient guidance")
     parser.add_argument("--plot", "-p", action="store_true", help="Whether to plot the procedural optimization of the embeddings")
+    parser.add_argument("--memory_storage", type=str, default="float32", choices=MEMORY_STORAGE, help="Storage of the cached memory embeddings; float16 / int8 / pq are scored asymmetrically on the codes")
+    parser.add_argument("--pq_subspaces", type=int, default=None, help="Number of PQ subspaces (default: one per 8 dimensions)")
+    parser.add_argument("--plot_max_points", type=int, default=5000, help="Maximum number of database embeddings used to fit and draw the PCA plot")
     parser.add_argument("--ppl_filter", "-ppl", action="store_true", help="Whether to enable coherence loss filter for token sampling")
     parser.add_argument("--asr_threshold", "-at", type=float, default=0.5, help="ASR threshold for target model loss")
+    parser.add_argument("--lambda_weight", type=float, default=0.1, help="Weight of the compactness loss L_cpt in the combined loss")
     parser.add_argument("--report_to_wandb", "-w", action="store_true", help="Whether to report the results to wandb")
+    parser.add_argument("--checkpoint_every", type=int, default=None, help=f"Save a checkpoint every N iterations (default {DEFAULT_CHECKPOINT_EVERY}, 0 to disable; not supported by beam search)")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None, help="Resume from the latest checkpoint, or from the given run directory / checkpoint file")
+    parser.add_argument("--device", "-d", type=str, default="auto", help="Device for the retriever and the coherence model ('auto' picks cuda:0 if available, else cpu)")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op CPU threads per process (default: the process's share of the cores)")
+    parser.add_argument("--num_interop_threads", type=int, default=None, help="Inter-op CPU threads per process")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed (restart workers use seed + rank)")
+    parser.add_argument("--num_restarts", "-r", type=int, default=1, help="Number of independent restarts run in parallel worker processes")
+    parser.add_argument("--exchange_every", type=int, default=10, help="Share the best trigger between restart workers every N iterations (0 to disable)")
+    return parser
+
+
+def load_resources(args, device, target_device):
+    """
+    Loads everything the optimization loop reads but never modifies: the retriever, the optional
+    coherence / target models, the database embeddings with their GMM cluster centers, the datasets
+    and the tokenized training queries.
+    """
+    resources = {"device": device, "target_device": target_device}
+    if args.forward_batch_size is None:
+        args.forward_batch_size = default_forward_batch_size(device)
 
-    args = parser.parse_args()
-
-    if args.report_to_wandb:
-        
-        wandb.login()
-        wandb.init(project='agentpoison')
-        config = wandb.config
-        config.agent = args.agent
-        config.model = args.model
-        config.batch_size = args.per_gpu_eval_batch_size
-        config.num_iter = args.num_iter
-        config.num_grad_iter = args.num_grad_iter
-        config.num_cand = args.num_cand
-        config.num_adv_passage_tokens = args.num_adv_passage_tokens
-        config.target_gradient_guidance = args.target_gradient_guidance
-        config.use_gpt = args.use_gpt
-        config.golden_trigger = args.golden_trigger
-        config.asr_threshold = args.asr_threshold
-        config.ppl_filter = args.ppl_filter
-        config.algo = args.algo
-
-    root_dir = f"{args.save_dir}/{config.agent}/{config.algo}/{str(datetime.datetime.now())}"
-    os.makedirs(root_dir, exist_ok=True)
-
-    # Open a file and set stdout to it
-    # stdout_file = open(f"{root_dir}/stdout.txt", "w")
-    # sys.stdout = stdout_file
-
-    device = "cuda:0"
-    target_device = "cuda:0"
     # Initialize the model and tokenizer
     model_code = args.model
     model, tokenizer, get_emb = load_models(model_code, device)
     model.eval() # Set the model to inference mode
+    resources["model"] = model
+    resources["tokenizer"] = tokenizer
+    # get word embeddings of retriever
+    resources["embeddings"] = get_embeddings(model)
+
+    ### target model ###
+    if args.target_gradient_guidance and not args.use_gpt:
+        target_model_code = "meta-llama-2-chat-7b"
+        target_model, target_tokenizer, get_target_emb = load_models(target_model_code)
+        target_model.eval() # Set the model to inference mode
+        resources["target_model"] = target_model
+        resources["target_tokenizer"] = target_tokenizer
+
+    if args.ppl_filter:
+        ppl_model_code = "gpt2"
+        ppl_model, ppl_tokenizer, get_ppl_emb = load_models(ppl_model_code, target_device)
+        ppl_model.eval()
+        resources["ppl_model"] = ppl_model
 
+    if args.agent == "ad":
+        database_samples_dir = "agentdriver/data/finetune/data_samples_train_100.json"
+        test_samples_dir = "agentdriver/data/finetune/data_samples_val_100.json"
+        db_dir = "agentdriver/data/memory"
+        if args.export_retriever is not None:
+            # forward-only encoding and candidate scoring; gradient accumulation stays in eager mode
+            resources["scoring_model"] = load_exported_retriever(model, model_code, args.export_retriever, db_dir)
+        # Load the database embeddings
+        if args.memory_storage == "float32":
+            db_embeddings = load_db_ad(database_samples_dir, db_dir, model_code, model, tokenizer, device, encoder=resources.get("scoring_model"))
+        else:
+            # kept on CPU as codes; the float32 embeddings are only loaded to build the cache
+            db_embeddings = load_compressed_embeddings(
+                lambda: load_db_ad(database_samples_dir, db_dir, model_code, model, tokenizer, device, encoder=resources.get("scoring_model")),
+                db_dir, model_code, args.memory_storage, args.pq_subspaces)
+            resources["memory_storage_report"] = db_embeddings.report
+        if args.quantized_scoring:
+            resources["quantized_model"] = load_quantized_retriever(model)
+        split_ratio = 1.0
+        train_dataset = AgentDriverDataset(test_samples_dir, split_ratio=split_ratio, train=True)
+        valid_dataset = AgentDriverDataset(test_samples_dir, split_ratio=split_ratio, train=False)
+
+        all_data = {"token":[], "ego":[], "perception":[]}
+        for sample in train_dataset:
+            all_data["token"].append(sample["token"])
+            all_data["ego"].append(sample["ego"])
+            all_data["perception"].append(sample["perception"])
+        resources["query_cache"] = build_query_cache(all_data, tokenizer)
+
+    # db_embeddings = db_embeddings[:5000]
+    # print("db_embeddings:", db_embeddings.shape)
+
+    # cached under db_dir, so resumed runs reuse the fitted mixture
+    cluster_centers, gmm_path = load_gmm_centers(db_embeddings, db_dir, model_code, n_components=5, device=device)
+
+    if args.vocab_filter:
+        admissible_ids = load_admissible_token_ids(tokenizer, db_dir, args.vocab_rules).to(device)
+        resources["admissible_ids"] = admissible_ids
+        resources["admissible_embeddings"] = admissible_embedding_matrix(resources["embeddings"].weight, admissible_ids)
+        print(f"Admissible vocabulary: {len(admissible_ids)} / {len(tokenizer)} tokens")
+
+    if args.knn_k > 0:
+        # int32 (V, k) neighbour ids, kept on CPU
+        resources["knn_graph"] = load_knn_graph(resources["embeddings"].weight, db_dir, model_code, args.knn_k, resources.get("admissible_ids"),
+                                                 args.vocab_rules)
+
+    resources["db_dir"] = db_dir
+    resources["db_embeddings"] = db_embeddings
+    resources["cluster_centers"] = cluster_centers
+    resources["gmm_path"] = gmm_path
+    resources["train_dataset"] = train_dataset
+    resources["valid_dataset"] = valid_dataset
+    resources["all_data"] = all_data
+
+    return resources
+
+
+def init_adv_passage(args, tokenizer, device):
     # Initialize adversarial passage
     if not args.golden_trigger:
         adv_passage_ids = [tokenizer.mask_token_id] * args.num_adv_passage_tokens
-        adv_passage_token_list = tokenizer.convert_ids_to_tokens(adv_passage_ids)
         print('Init adv_passage', tokenizer.convert_ids_to_tokens(adv_passage_ids))
         adv_passage_ids = torch.tensor(adv_passage_ids, device=device).unsqueeze(0)
     else:
@@ -390,42 +879,76 @@ if __name__ == "__main__":
         elif args.agent == "ehr":
             initial_trigger = "Be careful"
 
-        
+
         adv_passage_ids = tokenizer(initial_trigger, return_tensors="pt", padding=True, truncation=True, max_length=args.num_adv_passage_tokens).input_ids.to(device)
-        adv_passage_token_list = tokenizer.convert_ids_to_tokens(adv_passage_ids.squeeze(0))
-        args.num_adv_passage_tokens = len(adv_passage_token_list)
         print('Init adv_passage', tokenizer.convert_ids_to_tokens(adv_passage_ids.squeeze(0)))
 
-    # get word embeddings of retriever
-    embeddings = get_embeddings(model)
-    #print('Model embedding', embeddings)
-    embedding_gradient = GradientStorage(embeddings, args.num_adv_passage_tokens)
+    return adv_passage_ids
 
-    ### target model ###
-    target_gradient_guidance = args.target_gradient_guidance
-    if target_gradient_guidance:
-        if args.use_gpt:
-            last_best_asr = 0
+
+def restore_resume_args(parser, args, saved_args):
+    """
+    Restores the trajectory-affecting arguments of a resumed run from the checkpoint. Arguments left at their
+    default take the saved value; an explicitly different value raises a ValueError naming every mismatch.
+    """
+    mismatches = []
+    for name in RESUME_ARGS:
+        if name not in saved_args or getattr(args, name) == saved_args[name]:
+            continue
+        if getattr(args, name) == parser.get_default(name):
+            setattr(args, name, saved_args[name])
         else:
-            target_model_code = "meta-llama-2-chat-7b"
-            target_model, target_tokenizer, get_target_emb = load_models(target_model_code)
-            target_model.eval() # Set the model to inference mode
+            mismatches.append(f"--{name} {getattr(args, name)} (checkpoint: {saved_args[name]})")
+    if mismatches:
+        raise ValueError("Cannot resume with arguments that differ from the checkpoint: " + ", ".join(mismatches))
+
+
+def optimize_trigger(args, resources, root_dir, adv_passage_ids, checkpoint=None, exchange_fn=None):
+    """
+    Runs the trigger optimization loop from `adv_passage_ids`. `exchange_fn(it_, adv_passage_ids, score)`
+    is called after every iteration and may overwrite `adv_passage_ids` in place.
+    Returns the final and best trigger together with the metric history.
+    """
+    device = resources["device"]
+    target_device = resources["target_device"]
+    model = resources["model"]
+    tokenizer = resources["tokenizer"]
+    embeddings = resources["embeddings"]
+    db_embeddings = resources["db_embeddings"]
+    query_cache = resources.get("query_cache")
+    all_data = resources["all_data"]
+    gmm_path = resources["gmm_path"]
+    expanded_cluster_centers = resources["cluster_centers"].unsqueeze(0)
+    ppl_model = resources.get("ppl_model")
+    # hotflip ranks either the full vocabulary or the contiguous admissible sub-matrix
+    admissible_ids = resources.get("admissible_ids")
+    hotflip_embedding_matrix = resources["admissible_embeddings"] if admissible_ids is not None else embeddings.weight
+    knn_graph = resources.get("knn_graph")
+
+    if checkpoint is not None:
+        adv_passage_ids = checkpoint["adv_passage_ids"].to(device)
+        print('Resumed adv_passage', tokenizer.convert_ids_to_tokens(adv_passage_ids.squeeze(0)))
+        if checkpoint["gmm_path"] != gmm_path:
+            print(f"Warning: checkpoint was created with {checkpoint['gmm_path']}, using {gmm_path}")
+    adv_passage_token_list = tokenizer.convert_ids_to_tokens(adv_passage_ids.squeeze(0))
+    args.num_adv_passage_tokens = adv_passage_ids.shape[1]
 
-            target_model_embeddings = get_embeddings(target_model)
-            target_embedding_gradient = GradientStorage(target_model_embeddings, args.num_adv_passage_tokens)
+    embedding_gradient = GradientStorage(embeddings, args.num_adv_passage_tokens)
+
+    target_gradient_guidance = args.target_gradient_guidance
+    last_best_asr = 0
+    if target_gradient_guidance and not args.use_gpt:
+        target_model = resources["target_model"]
+        target_tokenizer = resources["target_tokenizer"]
 
     ppl_filter = args.ppl_filter
-    if ppl_filter:
-        ppl_model_code = "gpt2"
-        ppl_model, ppl_tokenizer, get_ppl_emb = load_models(ppl_model_code, target_device)
-        ppl_model.eval()
-    
 
     adv_passage_attention = torch.ones_like(adv_passage_ids, device=device)
     # adv_passage_token_type = torch.zeros_like(adv_passage_ids, device=device)
 
     best_adv_passage_ids = adv_passage_ids.clone()
-    
+    best_score = float('-inf')
+
     if args.agent == "ad":
         # CoT_example_set = [example_1_benign, example_2_benign, example_3_benign, example_4_benign, example_4_adv, example_8_benign, example_8_adv, example_6_benign, example_6_adv]
         CoT_example_set = [example_4_benign, example_4_adv, example_8_benign, example_8_adv, example_6_benign, example_6_adv, example_5_benign, example_5_adv]
@@ -434,206 +957,787 @@ if __name__ == "__main__":
         # CoT_example_set = [example_1_benign, spurious_example_1, example_2_benign, spurious_example_2, spurious_example_3, spurious_example_4]
         CoT_prefix, trigger_sequence = trigger_insertion(adv_passage_token_list, CoT_example_set, end_backdoor_reasoning_system_prompt)
 
-    if args.agent == "ad":
-        database_samples_dir = "agentdriver/data/finetune/data_samples_train_100.json"
-        test_samples_dir = "agentdriver/data/finetune/data_samples_val_100.json"
-        db_dir = "agentdriver/data/memory"
-        # Load the database embeddings
-        db_embeddings = load_db_ad(database_samples_dir, db_dir, model_code, model, tokenizer, device)
-        split_ratio = 1.0
-        train_dataset = AgentDriverDataset(test_samples_dir, split_ratio=split_ratio, train=True)
-        valid_dataset = AgentDriverDataset(test_samples_dir, split_ratio=split_ratio, train=False)
-        slice = 0
-
-    # db_embeddings = db_embeddings[:5000]
-    # print("db_embeddings:", db_embeddings.shape)
-
     # Initialize dataloaders
-    train_dataloader = DataLoader(train_dataset, batch_size=args.per_gpu_eval_batch_size, shuffle=True)
-    valid_dataloader = DataLoader(valid_dataset, batch_size=args.per_gpu_eval_batch_size, shuffle=False)
-    
-    if args.agent == "ad":
-        query_samples = []
-        all_data = {"ego":[], "perception":[]}
-        for idx, batch in enumerate(train_dataloader):
-            ego_batch = batch["ego"]
-            perception_batch = batch["perception"]
-            for ego, perception in zip(ego_batch, perception_batch):
-                # ego = add_zeros_to_numbers(ego, padding="0", desired_digits=3)
-                prompt = f"{ego} {perception}"
-                query_samples.append(prompt)
-                all_data["ego"].append(ego)
-                all_data["perception"].append(perception)
-
-    gmm = GaussianMixture(n_components=5, covariance_type='full', random_state=0)
-    gmm.fit(db_embeddings.cpu().detach().numpy())
-    cluster_centers = gmm.means_
-    cluster_centers = torch.tensor(cluster_centers).to(device)
-    expanded_cluster_centers = cluster_centers.unsqueeze(0)
-
-
-    for it_ in range(args.num_iter):
-        print(f"Iteration: {it_}")
-        
-        adv_passage_token_list = tokenizer.convert_ids_to_tokens(adv_passage_ids.squeeze(0))
-
-        if args.agent == "ad":
-            CoT_prefix, trigger_sequence = trigger_insertion(adv_passage_token_list, CoT_example_set, end_backdoor_reasoning_system_prompt)
-    
-        # print(f'Accumulating Gradient {args.num_grad_iter}')
-        model.zero_grad()
+    # explicit generator so that the shuffle order can be checkpointed
+    # a resumed run reuses the seed of the original one, so that the fixed eval partition below is the same
+    data_seed = checkpoint.get("data_seed", torch.initial_seed()) if checkpoint is not None else torch.initial_seed()
+    shuffle_generator = torch.Generator()
+    shuffle_generator.manual_seed(data_seed)
+    train_dataloader = DataLoader(resources["train_dataset"], batch_size=args.per_gpu_eval_batch_size, shuffle=True, generator=shuffle_generator)
+    valid_dataloader = DataLoader(resources["valid_dataset"], batch_size=args.per_gpu_eval_batch_size, shuffle=False)
+
+    score_cache = CandidateScoreCache(args.score_cache_size) if args.score_cache_size > 0 else None
+    if score_cache is not None:
+        # candidates are scored on one fixed partition of the training set, so (trigger, batch index) is a stable key
+        eval_batches = [materialize_batch(data, query_cache, args.num_adv_passage_tokens)
+                        for data in DataLoader(resources["train_dataset"], batch_size=args.per_gpu_eval_batch_size, shuffle=True, generator=shuffle_generator)]
+    tabu = TabuList(args.tabu_size) if args.tabu_size > 0 else None
+    scheduler = CandidateScheduler(args.num_cand, args.min_cand, args.max_cand if args.max_cand is not None else args.num_cand * 4,
+                                   adaptive=args.adaptive_cand, window=args.acceptance_window,
+                                   patience=args.early_stop_patience, plateau_tol=args.plateau_tol)
+    surrogate = SurrogateRanker(embeddings.weight, args.num_adv_passage_tokens, min_samples=args.surrogate_min_samples,
+                                min_fraction=args.surrogate_min_fraction) if args.surrogate else None
+
+    checkpoint_every = args.checkpoint_every if args.checkpoint_every is not None else DEFAULT_CHECKPOINT_EVERY
+    start_iter = 0
+    history = []
+    if checkpoint is not None:
+        start_iter = checkpoint["iteration"]
+        history = checkpoint["history"]
+        last_best_asr = checkpoint["last_best_asr"]
+        best_score = checkpoint.get("best_score", best_score)
+        best_adv_passage_ids = checkpoint.get("best_adv_passage_ids", adv_passage_ids).to(device)
+        set_rng_state(checkpoint["rng_state"], shuffle_generator)
+        if "scheduler" in checkpoint:
+            scheduler.load_state_dict(checkpoint["scheduler"])
+        if tabu is not None and checkpoint.get("tabu") is not None:
+            tabu.load_state_dict(checkpoint["tabu"])
+        if surrogate is not None and checkpoint.get("surrogate") is not None:
+            surrogate.load_state_dict(checkpoint["surrogate"])
+
+    if args.plot:
+        # PCA is fitted once on the database; rendering happens in a background process
+        pca_plotter = PCAPlotter(db_embeddings, root_dir, max_points=args.plot_max_points, report_to_wandb=args.report_to_wandb)
+        # when the gradient pass covers the whole training set, its embeddings are reused for plotting
+        plot_from_grad_pass = len(train_dataloader) <= args.num_grad_iter and get_world_size() == 1
 
-        # pbar = range(args.num_grad_iter)
+    try:
+        for it_ in range(start_iter, args.num_iter):
+            print(f"Iteration: {it_}")
 
-        train_iter = iter(train_dataloader)
-        # pbar is number of batches
-        pbar = range(min(len(train_dataloader), args.num_grad_iter))
+            adv_passage_token_list = tokenizer.convert_ids_to_tokens(adv_passage_ids.squeeze(0))
 
-        grad = None
+            if args.agent == "ad":
+                CoT_prefix, trigger_sequence = trigger_insertion(adv_passage_token_list, CoT_example_set, end_backdoor_reasoning_system_prompt)
 
-        loss_sum = 0
+            # print(f'Accumulating Gradient {args.num_grad_iter}')
+            model.zero_grad()
+            embedding_gradient.reset()
+            embedding_gradient.attach()
 
-        for _ in pbar:
+            # pbar = range(args.num_grad_iter)
 
-            data = next(train_iter)
-            if args.agent == "ad" :
-                query_embeddings = bert_get_adv_emb(data, model, tokenizer, args.num_adv_passage_tokens, adv_passage_ids, adv_passage_attention)
-            if args.algo == "ap":
-                loss = compute_avg_cluster_distance(query_embeddings, expanded_cluster_centers)
+            # pbar is number of batches
+            pbar = range(min(len(train_dataloader), args.num_grad_iter))
+            # (batch_idx, data) pairs materialized once and shared by the gradient pass and candidate scoring;
+            # batch indices are only stable keys when the score cache fixes the batches
+            if score_cache is not None:
+                batches = list(enumerate(eval_batches[:len(pbar)]))
+            else:
+                train_iter = iter(train_dataloader)
+                batches = [(None, materialize_batch(next(train_iter), query_cache, args.num_adv_passage_tokens)) for _ in pbar]
+
+            grad_pass_embeddings = []
+            query_embeddings = None
+
+            for batch_pos, (_, data) in enumerate(batches):
+                # under data parallelism each worker accumulates a round-robin share of the batches
+                if batch_pos % get_world_size() != get_rank():
+                    continue
+
+                if args.agent == "ad" :
+                    query_embeddings = bert_get_adv_emb(data, model, tokenizer, args.num_adv_passage_tokens, adv_passage_ids, adv_passage_attention, device=device, query_cache=query_cache)
+                if args.algo == "ap":
+                    loss = compute_avg_cluster_distance(query_embeddings, expanded_cluster_centers, args.lambda_weight)
+
+                # sim = torch.mm(query_embeddings, db_embeddings.T)
+                # loss = sim.mean()
+                loss.backward()
+
+                if args.plot and plot_from_grad_pass:
+                    grad_pass_embeddings.append(query_embeddings.detach())
+
+            # averaged in place; the buffer is only cleared by the next gradient pass
+            grad = all_reduce_sum(embedding_gradient.get()).div_(len(pbar))
+            # candidate scoring is forward-only
+            embedding_gradient.detach()
+
+            # the gradient pass encoded the trigger produced by the previous iteration
+            if args.plot and plot_from_grad_pass and it_ > 0:
+                pca_plotter.submit(torch.cat(grad_pass_embeddings, dim=0), title=f"Iteration {it_ - 1}")
+            del grad_pass_embeddings
+
+            # print('Loss', loss_sum)
+            # print('Evaluating Candidates')
+
+            num_cand = scheduler.num_cand
+            num_pool = num_cand*10 if ppl_filter else num_cand
+            # recently rejected swaps are masked out of the ranking
+            tabu_filter = tabu.filter(args.num_adv_passage_tokens, embeddings.weight.shape[0], grad.device) if tabu is not None else None
+            if args.multi_position:
+                # Get candidate swaps over all positions from the same gradient
+                candidates, candidate_positions = hotflip_attack_multi(grad,
+                                                hotflip_embedding_matrix,
+                                                adv_passage_ids[0],
+                                                num_candidates=num_pool,
+                                                filter=tabu_filter,
+                                                slice=None,
+                                                admissible_ids=admissible_ids)
+            else:
+                token_to_flip = random.randrange(args.num_adv_passage_tokens)
+                # Get candidate tokens - Step 6 (Eq. 4)
+                candidates = hotflip_attack(grad[token_to_flip],
+                            hotflip_embedding_matrix,
+                            increase_loss=True,
+                            num_candidates=num_pool,
+                            filter=tabu_filter[token_to_flip] if tabu_filter is not None else None,
+                            slice=None,
+                            admissible_ids=admissible_ids,
+                            current_token=adv_passage_ids[0, token_to_flip])
+                candidate_positions = torch.full_like(candidates, token_to_flip)
+
+            if knn_graph is not None:
+                # neighbours of the current tokens, re-ranked by the same gradient
+                if args.multi_position:
+                    knn_positions = torch.arange(args.num_adv_passage_tokens, device=grad.device)
+                else:
+                    knn_positions = torch.tensor([token_to_flip], device=grad.device)
+                knn_cands, knn_cand_positions = knn_candidates(knn_graph, grad, embeddings.weight, adv_passage_ids[0],
+                                                               knn_positions, args.knn_pool, filter=tabu_filter)
+                if args.knn_switch_iter >= 0 and it_ >= args.knn_switch_iter:
+                    # later iterations only search the neighbourhood
+                    candidates, candidate_positions = knn_cands, knn_cand_positions
+                else:
+                    candidates, candidate_positions = merge_candidate_pools(torch.cat((candidates, knn_cands)),
+                                                                            torch.cat((candidate_positions, knn_cand_positions)),
+                                                                            embeddings.weight.shape[0])
+
+            if ppl_filter:
+                # Apply coherence filter if enabled - Step 7 (Eq. 10)
+                candidates, candidate_positions = candidate_filter(candidates,
+                                    num_candidates=num_cand,
+                                    token_to_flip=candidate_positions,
+                                    adv_passage_ids=adv_passage_ids,
+                                    ppl_model=ppl_model,
+                                    device=target_device)
+
+            if surrogate is not None:
+                # only the swaps the surrogate ranks highest get a real evaluation
+                surrogate_features = surrogate.features(adv_passage_ids[0], candidates, candidate_positions)
+                keep_idx = surrogate.select(surrogate_features)
+                print(f"Surrogate: evaluating {len(keep_idx)}/{len(candidates)} candidates")
+                surrogate_features = surrogate_features[keep_idx]
+                keep_idx = keep_idx.to(candidates.device)
+                candidates, candidate_positions = candidates[keep_idx], candidate_positions[keep_idx]
+
+            # one trigger per candidate swap
+            candidate_passage_ids = adv_passage_ids.repeat(len(candidates), 1)
+            candidate_passage_ids[torch.arange(len(candidates), device=candidate_passage_ids.device), candidate_positions] = candidates
+
+            current_score = 0
+            candidate_scores = torch.zeros(len(candidates), dtype=torch.float64, device=device)
+            current_acc_rate = 0
+            candidate_acc_rates = torch.zeros(len(candidates), device=device)
+
+            # the incumbent rides along as row 0 of every scoring call on the batches of the gradient pass, so it
+            # is scored by the same model, autocast and padded layout as the candidates it is compared against
+            eval_iter = ((batch_pos, batch) for batch_pos, batch in enumerate(batches))
+            eval_passage_ids = torch.cat((adv_passage_ids, candidate_passage_ids), dim=0)
+
+            if args.successive_halving:
+                def halving_score_fn(eval_batch, idx):
+                    _, batch = eval_batch
+                    return score_candidates(args, resources, batch, eval_passage_ids[idx.to(eval_passage_ids.device)], score_cache).cpu()
+
+                eval_scores, num_scored = successive_halving(halving_score_fn, eval_passage_ids.shape[0], eval_iter, len(pbar), keep_fraction=args.halving_keep)
+                print(f"Successive halving: {num_scored} batches scored")
+                current_score = eval_scores[0].item()
+                candidate_scores = eval_scores[1:].to(device)
+                num_eval_batches = num_scored
+            else:
+                eval_scores = torch.zeros(eval_passage_ids.shape[0], dtype=torch.float64, device=device)
+                for _, batch in tqdm(eval_iter, total=len(pbar)):
 
-            # sim = torch.mm(query_embeddings, db_embeddings.T)
-            # loss = sim.mean()
-            loss_sum += loss.cpu().item()
-            loss.backward()
+                    # the incumbent and all candidates on this batch in a few padded forwards
+                    eval_scores += score_candidates(args, resources, batch, eval_passage_ids, score_cache)
+                    # candidate_acc_rates[i] += can_suc_att
 
-            temp_grad = embedding_gradient.get()                
-            grad_sum = temp_grad.sum(dim=0) 
+                current_score = eval_scores[0].item()
+                candidate_scores = eval_scores[1:]
+                num_eval_batches = len(pbar)
+
+            # per-batch means: successive halving scores a different number of batches every iteration, so raw
+            # sums are not comparable with best_score, the scheduler or the other restarts
+            current_score /= max(num_eval_batches, 1)
+            candidate_scores = candidate_scores / max(num_eval_batches, 1)
+
+            if surrogate is not None:
+                # candidates pruned by successive halving have no full score to learn from
+                scored = torch.isfinite(candidate_scores).cpu()
+                gains = candidate_scores.cpu() - current_score
+                surrogate.update(surrogate_features[scored], gains[scored])
+                if surrogate.correlation is not None:
+                    print(f"Surrogate: Spearman {surrogate.correlation:.3f}, eval fraction {surrogate.eval_fraction:.2f}")
+
+            if resources.get("quantized_model") is not None:
+                scored_batches = batches[:num_eval_batches]
+                if args.agreement_every > 0 and it_ % args.agreement_every == 0:
+                    pool_scores = torch.cat((torch.tensor([current_score], dtype=torch.float64, device=candidate_scores.device), candidate_scores))
+                    report_quantized_agreement(args, resources, scored_batches, eval_passage_ids, pool_scores)
+                if args.rescore_top > 0:
+                    # the incumbent and the int8 top few are re-scored with the full-precision retriever on the same
+                    # batches; only they can be accepted, so no int8 score is ever compared with an exact one
+                    num_rescore = min(args.rescore_top, int(torch.isfinite(candidate_scores).sum()))
+                    rescore_idx = candidate_scores.topk(num_rescore).indices
+                    rescore_rows = torch.cat((torch.zeros(1, dtype=torch.long, device=rescore_idx.device), rescore_idx + 1))
+                    exact_scores = score_exact(args, resources, scored_batches, eval_passage_ids[rescore_rows.to(eval_passage_ids.device)]) / max(num_eval_batches, 1)
+                    current_score = exact_scores[0].item()
+                    candidate_scores = torch.full_like(candidate_scores, float('-inf'))
+                    candidate_scores[rescore_idx] = exact_scores[1:].to(candidate_scores.device)
+
+            if score_cache is not None:
+                print(f"Score cache: {score_cache.hits} hits, {score_cache.misses} misses")
+            # print(current_score, max(candidate_scores).cpu().item())
+
+            # target_prob = target_word_prob(data, model, tokenizer, args.num_adv_passage_tokens, adv_passage_ids, adv_passage_attention, "stop", target_device)
+
+            # if find a better one, update
+            # best_candidate_set = candidates[torch.argmax(candidate_scores)]
+            improved = bool((candidate_scores > current_score).any())
+            trigger_score = current_score
+            if improved: #or (candidate_acc_rates > current_acc_rate).any():
+                # logger.info('Better adv_passage detected.')
+
+                if not target_gradient_guidance:
+                    best_candidate_score = candidate_scores.max()
+                    best_candidate_idx = candidate_scores.argmax()
+                else:
+                    last_best_asr = 0
+                    # get all the candidates that are better than the current one
+                    better_candidates = candidates[candidate_scores > current_score]
+                    better_candidates_idx = torch.where(candidate_scores > current_score)[0]
+                    # print('Better candidates', better_candidates_idx)
+
+                    target_asr_idx = []
+                    target_loss_list = []
+                    # Step 8: Update Sτ′ from Sτ (Eq. 11)
+                    # Filter candidates based on target model performance
+                    for i, idx in enumerate(better_candidates_idx):
+                        temp_adv_passage_ids = candidate_passage_ids[idx:idx + 1].clone()
+                        if args.use_gpt:
+                            target_loss = target_asr(data, 10, "STOP", CoT_prefix, trigger_sequence, target_device)
+                            # Only keep candidates that meet ASR threshold or improve previous best
+                            if target_loss > args.asr_threshold or target_loss > last_best_asr:
+                                target_asr_idx.append(idx.item())
+                                target_loss_list.append(target_loss)
+                        else:
+                            target_loss = target_word_prob(data, target_model, target_tokenizer,
+                                args.num_adv_passage_tokens, temp_adv_passage_ids,
+                                adv_passage_attention, "STOP", CoT_prefix,
+                                trigger_sequence, target_device)
+
+                    if len(target_asr_idx) > 0:
+                        # Step 10: Select best candidate from filtered set Sτ′
+                        best_candidate_scores = candidate_scores[target_asr_idx]
+                        asr_max_idx = torch.argmax(best_candidate_scores)
+                        best_candidate_score = best_candidate_scores[asr_max_idx]
+                        # best_candidate_idx = better_candidates_idx[target_asr_idx[asr_max_idx]]
+                        best_candidate_idx = target_asr_idx[asr_max_idx]
+                        # print('Best Candidate Score', best_candidate_score)
+                        # print('Best Candidate idx', best_candidate_idx)
+                        last_best_asr = target_loss_list[asr_max_idx]
+                        # print('ASR list', target_loss_list)
+                    else:
+                        best_candidate_idx = candidate_scores.argmax()
 
-            if grad is None:
-                grad = grad_sum / args.num_grad_iter
+                    print('Best ASR', last_best_asr)
+                adv_passage_ids[0] = candidate_passage_ids[best_candidate_idx]
+                trigger_score = candidate_scores[best_candidate_idx].item()
+                print('Current adv_passage', tokenizer.convert_ids_to_tokens(adv_passage_ids[0]))
+                print()
             else:
-                grad += grad_sum / args.num_grad_iter
+                print('No improvement detected!')
 
-        # print('Loss', loss_sum)
-        # print('Evaluating Candidates')
-        pbar = range(min(len(train_dataloader), args.num_grad_iter))
-        train_iter = iter(train_dataloader)
+            if tabu is not None:
+                for position, token in zip(candidate_positions[candidate_scores <= current_score].tolist(), candidates[candidate_scores <= current_score].tolist()):
+                    tabu.add(position, token)
 
-        token_to_flip = random.randrange(args.num_adv_passage_tokens)
-        
-        if ppl_filter:
-            # Get candidate tokens - Step 6 (Eq. 4)
-            candidates = hotflip_attack(grad[token_to_flip],
-                                        embeddings.weight,
-                                        increase_loss=True,
-                                        num_candidates=args.num_cand*10,
-                                        filter=None,
-                                        slice=None)
-            # Apply coherence filter if enabled - Step 7 (Eq. 10)
-            candidates = candidate_filter(candidates, 
-                                num_candidates=args.num_cand, 
-                                token_to_flip=token_to_flip,
-                                adv_passage_ids=adv_passage_ids,
-                                ppl_model=ppl_model) 
+            if trigger_score > best_score:
+                best_score = trigger_score
+                best_adv_passage_ids = adv_passage_ids.clone()
+
+            stop_reason = scheduler.update(improved, best_score)
+            try:
+                wandb.log({"Acceptance rate": scheduler.acceptance_rate, "Num candidates": num_cand})
+            except Exception as e:
+                print(e)
+                pass
+
+            # plot; with plot_from_grad_pass the next gradient pass plots this iteration, unless it is the last one
+            if args.plot and (not plot_from_grad_pass or it_ == args.num_iter - 1 or stop_reason is not None):
+                with torch.no_grad():
+                    current_embeddings = bert_get_adv_emb(all_data, model, tokenizer, args.num_adv_passage_tokens, adv_passage_ids, adv_passage_attention, device=device, query_cache=query_cache)
+                pca_plotter.submit(current_embeddings, title=f"Iteration {it_}")
+                del current_embeddings
+
+            del query_embeddings
+            gc.collect()
+
+            history.append({
+                "iteration": it_,
+                "loss": current_score,
+                "best_candidate_score": candidate_scores.max().item() if len(candidate_scores) > 0 else float('-inf'),
+                "improved": improved,
+                "num_cand": num_cand,
+                "adv_passage": tokenizer.convert_ids_to_tokens(adv_passage_ids[0]),
+            })
+
+            if exchange_fn is not None:
+                exchange_fn(it_, adv_passage_ids, trigger_score)
+
+            if checkpoint_every > 0 and get_rank() == 0 and ((it_ + 1) % checkpoint_every == 0 or it_ == args.num_iter - 1 or stop_reason is not None):
+                save_checkpoint(root_dir, {
+                    "iteration": it_ + 1,
+                    "adv_passage_ids": adv_passage_ids.cpu(),
+                    "best_adv_passage_ids": best_adv_passage_ids.cpu(),
+                    "best_score": best_score,
+                    "last_best_asr": last_best_asr,
+                    "rng_state": get_rng_state(shuffle_generator),
+                    "data_seed": data_seed,
+                    "history": history,
+                    "scheduler": scheduler.state_dict(),
+                    "surrogate": surrogate.state_dict() if surrogate is not None else None,
+                    "tabu": tabu.state_dict() if tabu is not None else None,
+                    "stop_reason": stop_reason,
+                    "gmm_path": gmm_path,
+                    "args": vars(args),
+                })
+
+            if stop_reason is not None:
+                print(f"Converged at iteration {it_}: {stop_reason}")
+                break
         else:
-            candidates = hotflip_attack(grad[token_to_flip],
-                        embeddings.weight,
-                        increase_loss=True,
-                        num_candidates=args.num_cand,
-                        filter=None,
-                        slice=None)
-        
-        current_score = 0
-        candidate_scores = torch.zeros(args.num_cand, device=device)
-        current_acc_rate = 0
-        candidate_acc_rates = torch.zeros(args.num_cand, device=device)
+            stop_reason = f"reached num_iter={args.num_iter}"
+    finally:
+        embedding_gradient.remove()
+        if args.plot:
+            pca_plotter.close()
 
-        for step in tqdm(pbar):
+    return {
+        "adv_passage_ids": adv_passage_ids.cpu(),
+        "best_adv_passage_ids": best_adv_passage_ids.cpu(),
+        "best_score": best_score,
+        "best_adv_passage": tokenizer.convert_ids_to_tokens(best_adv_passage_ids[0]),
+        "history": history,
+        "stop_reason": stop_reason,
+    }
 
-            data = next(train_iter)
 
-            for i, candidate in enumerate(candidates):
-                temp_adv_passage = adv_passage_ids.clone()
-                temp_adv_passage[:, token_to_flip] = candidate
-                if args.agent == "ad":
-                    candidate_query_embeddings = bert_get_adv_emb(data, model, tokenizer, args.num_adv_passage_tokens, temp_adv_passage, adv_passage_attention)
+def optimize_trigger_beam(args, resources, root_dir, adv_passage_ids):
+    """
+    Beam-search variant of `optimize_trigger`. The top `args.beam_width` triggers are kept; every
+    iteration one shared forward/backward pass runs all beams stacked as rows of the same batches, which
+    gives each beam its own gradient. Each beam is expanded with `args.beam_cands` multi-position hotflip
+    swaps, and the beams and all beam x candidate expansions are scored together in one batched
+    evaluation per data batch, so they are compared with the same model on exactly the same batches.
+    The top `args.beam_width` distinct triggers survive.
+    Returns the final and best trigger together with the metric history.
+    """
+    device = resources["device"]
+    model = resources["model"]
+    tokenizer = resources["tokenizer"]
+    embeddings = resources["embeddings"]
+    query_cache = resources.get("query_cache")
+    all_data = resources["all_data"]
+    expanded_cluster_centers = resources["cluster_centers"].unsqueeze(0)
+    admissible_ids = resources.get("admissible_ids")
+    hotflip_embedding_matrix = resources["admissible_embeddings"] if admissible_ids is not None else embeddings.weight
+
+    args.num_adv_passage_tokens = adv_passage_ids.shape[1]
+    embedding_gradient = GradientStorage(embeddings, args.num_adv_passage_tokens, num_rows=args.beam_width)
+    adv_passage_attention = torch.ones_like(adv_passage_ids, device=device)
+
+    train_dataloader = DataLoader(resources["train_dataset"], batch_size=args.per_gpu_eval_batch_size, shuffle=True)
+    num_batches = min(len(train_dataloader), args.num_grad_iter)
+
+    # (B, T) beams; the search starts from the single initial trigger
+    beam_passage_ids = adv_passage_ids.clone()
+    best_adv_passage_ids = adv_passage_ids.clone()
+    best_score = float('-inf')
+    history = []
 
+    if args.plot:
+        pca_plotter = PCAPlotter(resources["db_embeddings"], root_dir, max_points=args.plot_max_points, report_to_wandb=args.report_to_wandb)
+
+    try:
+        for it_ in range(args.num_iter):
+            print(f"Iteration: {it_}")
+
+            # the same batches serve the gradient pass, the beam baselines and the expansion scores
+            train_iter = iter(train_dataloader)
+            batches = [materialize_batch(next(train_iter), query_cache, args.num_adv_passage_tokens) for _ in range(num_batches)]
+
+            num_beams = beam_passage_ids.shape[0]
+            model.zero_grad()
+            embedding_gradient.reset()
+            embedding_gradient.attach()
+            for data in batches:
+                # (B, Q, D): the beams never interact, so the summed loss backpropagates each beam's own gradient into its row
+                query_embeddings = bert_get_adv_emb_stacked(data, model, args.num_adv_passage_tokens, beam_passage_ids, device=device)
+                loss = sum(compute_avg_cluster_distance(query_embeddings[b], expanded_cluster_centers, args.lambda_weight) for b in range(num_beams))
+                loss.backward()
+                del query_embeddings
+            beam_grads = embedding_gradient.get()[:num_beams] / num_batches
+            embedding_gradient.detach()
+
+            # B x C expansions, with duplicates and triggers already in the beam removed
+            expansions = []
+            for b in range(num_beams):
+                candidates, candidate_positions = hotflip_attack_multi(beam_grads[b],
+                                                    hotflip_embedding_matrix,
+                                                    beam_passage_ids[b],
+                                                    num_candidates=args.beam_cands,
+                                                    admissible_ids=admissible_ids)
+                expansion_ids = beam_passage_ids[b:b + 1].repeat(len(candidates), 1)
+                expansion_ids[torch.arange(len(candidates), device=expansion_ids.device), candidate_positions] = candidates
+                expansions.append(expansion_ids)
+            expansion_passage_ids = torch.unique(torch.cat(expansions, dim=0), dim=0)
+            is_beam = (expansion_passage_ids.unsqueeze(1) == beam_passage_ids.unsqueeze(0)).all(dim=2).any(dim=1)
+            expansion_passage_ids = expansion_passage_ids[~is_beam]
+
+            pool_passage_ids = torch.cat((beam_passage_ids, expansion_passage_ids), dim=0)
+            pool_scores = torch.zeros(pool_passage_ids.shape[0], dtype=torch.float64)
+            for data in tqdm(batches):
+                # the beams and every expansion of every beam on this batch in a few padded forwards
+                pool_scores += score_candidate_batch(args, resources, data, pool_passage_ids).cpu()
+            if resources.get("quantized_model") is not None:
+                scored_batches = [(None, data) for data in batches]
+                if args.agreement_every > 0 and it_ % args.agreement_every == 0:
+                    report_quantized_agreement(args, resources, scored_batches, pool_passage_ids, pool_scores)
+                if args.rescore_top > 0:
+                    # the current beams and the int8 top few are re-scored exactly; survivors and the improvement
+                    # check only ever see exact scores
+                    num_rescore = min(max(args.rescore_top, args.beam_width), len(pool_scores))
+                    rescore_idx = torch.unique(torch.cat((torch.arange(num_beams), pool_scores.topk(num_rescore).indices)))
+                    exact_scores = score_exact(args, resources, scored_batches, pool_passage_ids[rescore_idx.to(pool_passage_ids.device)]).cpu()
+                    pool_scores = torch.full_like(pool_scores, float('-inf'))
+                    pool_scores[rescore_idx] = exact_scores
+            beam_scores, expansion_scores = pool_scores[:num_beams], pool_scores[num_beams:]
+
+            top_scores, top_idx = pool_scores.topk(min(args.beam_width, len(pool_scores)))
+            improved = bool(top_scores[0] > beam_scores.max())
+            beam_passage_ids = pool_passage_ids[top_idx.to(pool_passage_ids.device)]
+
+            if top_scores[0].item() > best_score:
+                best_score = top_scores[0].item()
+                best_adv_passage_ids = beam_passage_ids[:1].clone()
+            print(f"Beam scores: {[round(s, 4) for s in top_scores.tolist()]} ({len(expansion_passage_ids)} expansions)")
+            print('Current adv_passage', tokenizer.convert_ids_to_tokens(beam_passage_ids[0]))
+
+            try:
+                wandb.log({"Beam best score": top_scores[0].item(), "Beam worst score": top_scores[-1].item()})
+            except Exception as e:
+                print(e)
+                pass
+
+            if args.plot:
                 with torch.no_grad():
-                    if args.algo == "ap":
-                        can_loss = compute_avg_cluster_distance(candidate_query_embeddings, expanded_cluster_centers)
-                    temp_score = can_loss.sum().cpu().item()
-                    candidate_scores[i] += temp_score
-                    # candidate_acc_rates[i] += can_suc_att
+                    current_embeddings = bert_get_adv_emb(all_data, model, tokenizer, args.num_adv_passage_tokens, beam_passage_ids[:1], adv_passage_attention, device=device, query_cache=query_cache)
+                pca_plotter.submit(current_embeddings, title=f"Iteration {it_}")
+                del current_embeddings
+
+            gc.collect()
+
+            history.append({
+                "iteration": it_,
+                "loss": beam_scores.max().item(),
+                "best_candidate_score": expansion_scores.max().item() if len(expansion_scores) > 0 else float('-inf'),
+                "improved": improved,
+                "adv_passage": tokenizer.convert_ids_to_tokens(beam_passage_ids[0]),
+            })
+    finally:
+        embedding_gradient.remove()
+        if args.plot:
+            pca_plotter.close()
 
-                # delete candidate_query_embeddings
-                del candidate_query_embeddings
+    return {
+        "adv_passage_ids": beam_passage_ids[:1].cpu(),
+        "best_adv_passage_ids": best_adv_passage_ids.cpu(),
+        "best_score": best_score,
+        "best_adv_passage": tokenizer.convert_ids_to_tokens(best_adv_passage_ids[0]),
+        "history": history,
+    }
 
-        current_score = loss_sum
-        # print(current_score, max(candidate_scores).cpu().item())
 
-        # target_prob = target_word_prob(data, model, tokenizer, args.num_adv_passage_tokens, adv_passage_ids, adv_passage_attention, "stop", target_device)
+def collect_worker_results(result_queue, workers, num_results, poll_interval=10):
+    """
+    Gathers `num_results` `("ok", payload)` messages from `result_queue`. A worker that reports
+    `("error", rank, traceback)` or exits without reporting stops the other workers and raises a RuntimeError.
+    """
+    results = []
+    try:
+        while len(results) < num_results:
+            try:
+                message = result_queue.get(timeout=poll_interval)
+            except queue.Empty:
+                for rank, worker in enumerate(workers):
+                    if worker.exitcode not in (None, 0):
+                        raise RuntimeError(f"Worker {rank} exited with code {worker.exitcode}")
+                if all(worker.exitcode is not None for worker in workers):
+                    raise RuntimeError("Workers exited without reporting a result")
+                continue
+            if message[0] == "error":
+                _, rank, trace = message
+                raise RuntimeError(f"Worker {rank} failed:\n{trace}")
+            results.append(message[1])
+    except BaseException:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+        raise
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def restart_worker(rank, args, resources, root_dir, adv_passage_ids, shared_best, result_queue):
+    """
+    Runs one independent restart. Every `args.exchange_every` iterations the worker publishes its
+    trigger to `shared_best` if it beats the global best, and otherwise adopts the global best.
+    Failures are reported to the parent through `result_queue`.
+    """
+    try:
+        _restart_worker(rank, args, resources, root_dir, adv_passage_ids, shared_best, result_queue)
+    except BaseException:
+        result_queue.put(("error", rank, traceback.format_exc()))
+        raise
 
-        # if find a better one, update
-        # best_candidate_set = candidates[torch.argmax(candidate_scores)]
-        if (candidate_scores > current_score).any(): #or (candidate_acc_rates > current_acc_rate).any():
-            # logger.info('Better adv_passage detected.')
 
-            if not target_gradient_guidance:
-                best_candidate_score = candidate_scores.max()
-                best_candidate_idx = candidate_scores.argmax()
-            else:
-                last_best_asr = 0
-                # get all the candidates that are better than the current one
-                better_candidates = candidates[candidate_scores > current_score]
-                better_candidates_idx = torch.where(candidate_scores > current_score)[0]
-                # print('Better candidates', better_candidates_idx)
-                
-                target_asr_idx = []
-                target_loss_list = []
-                # Step 8: Update Sτ′ from Sτ (Eq. 11)
-                # Filter candidates based on target model performance
-                for i, idx in enumerate(better_candidates_idx):
-                    temp_adv_passage_ids = adv_passage_ids.clone()
-                    temp_adv_passage_ids[:, token_to_flip] = candidates[idx]
-                    if args.use_gpt:
-                        target_loss = target_asr(data, 10, "STOP", CoT_prefix, trigger_sequence, target_device)
-                        # Only keep candidates that meet ASR threshold or improve previous best
-                        if target_loss > args.asr_threshold or target_loss > last_best_asr:
-                            target_asr_idx.append(idx.item())
-                            target_loss_list.append(target_loss)
-                    else:
-                        target_loss = target_word_prob(data, target_model, target_tokenizer, 
-                            args.num_adv_passage_tokens, temp_adv_passage_ids, 
-                            adv_passage_attention, "STOP", CoT_prefix, 
-                            trigger_sequence, target_device)
-
-                if len(target_asr_idx) > 0:
-                    # Step 10: Select best candidate from filtered set Sτ′
-                    best_candidate_scores = candidate_scores[target_asr_idx]
-                    asr_max_idx = torch.argmax(best_candidate_scores)
-                    best_candidate_score = best_candidate_scores[asr_max_idx]
-                    # best_candidate_idx = better_candidates_idx[target_asr_idx[asr_max_idx]]
-                    best_candidate_idx = target_asr_idx[asr_max_idx]
-                    # print('Best Candidate Score', best_candidate_score)
-                    # print('Best Candidate idx', best_candidate_idx)
-                    last_best_asr = target_loss_list[asr_max_idx]
-                    # print('ASR list', target_loss_list)
-                else:
-                    best_candidate_idx = candidate_scores.argmax()
+def _restart_worker(rank, args, resources, root_dir, adv_passage_ids, shared_best, result_queue):
+    random.seed(args.seed + rank)
+    torch.manual_seed(args.seed + rank)
+    if resources["device"] == "cpu":
+        configure_cpu_threads(args.num_restarts, args.num_threads, args.num_interop_threads)
 
-                print('Best ASR', last_best_asr)
-            adv_passage_ids[:, token_to_flip] = candidates[best_candidate_idx]
-            print('Current adv_passage', tokenizer.convert_ids_to_tokens(adv_passage_ids[0]))
-            print()
-        else:
-            print('No improvement detected!')
+    best_ids, best_score, lock = shared_best
 
-        # plot
-        if args.plot:
-            with torch.no_grad():
-                current_embeddings = bert_get_adv_emb(all_data, model, tokenizer, args.num_adv_passage_tokens, adv_passage_ids, adv_passage_attention)
-            plot_PCA(current_embeddings, db_embeddings, root_dir, title=f"Iteration {it_}")
-            del current_embeddings
-            
-        del query_embeddings
-        gc.collect()
\ No newline at end of file
+    def exchange_fn(it_, adv_passage_ids, score):
+        if args.exchange_every <= 0 or (it_ + 1) % args.exchange_every != 0:
+            return
+        with lock:
+            if score > best_score.value:
+                best_score.value = score
+                best_ids.copy_(adv_passage_ids[0].cpu())
+            elif best_score.value > score:
+                adv_passage_ids[0] = best_ids.to(adv_passage_ids.device)
+
+    resources = worker_resources(resources)
+
+    worker_args = argparse.Namespace(**vars(args))
+    # only the first worker renders plots
+    worker_args.plot = args.plot and rank == 0
+    worker_dir = f"{root_dir}/restart_{rank}"
+    os.makedirs(worker_dir, exist_ok=True)
+
+    result = optimize_trigger(worker_args, resources, worker_dir, adv_passage_ids.clone(), exchange_fn=exchange_fn)
+    result_queue.put(("ok", (rank, result["best_score"], result["best_adv_passage_ids"], result["history"])))
+
+
+def run_parallel_restarts(args, resources, root_dir, adv_passage_ids):
+    """
+    Forks `args.num_restarts` workers over the same read-only resources and returns the global best trigger.
+    The database is memory-mapped and the retriever weights, cluster centers and tokenized queries are
+    shared with the workers rather than copied.
+    """
+    if args.seed is None:
+        args.seed = random.randrange(2**31)
+
+    resources = dict(resources)
+    db_embeddings, _ = memmap_db_embeddings(resources["db_embeddings"], resources["db_dir"], args.model)
+    resources["db_embeddings"] = db_embeddings
+
+    ctx, resources = worker_context(resources)
+
+    best_ids = torch.zeros(adv_passage_ids.shape[1], dtype=torch.long).share_memory_()
+    best_ids.copy_(adv_passage_ids[0].cpu())
+    best_score = ctx.Value('d', float('-inf'))
+    lock = ctx.Lock()
+    result_queue = ctx.Queue()
+
+    workers = []
+    for rank in range(args.num_restarts):
+        worker = ctx.Process(target=restart_worker,
+                             args=(rank, args, resources, root_dir, adv_passage_ids, (best_ids, best_score, lock), result_queue))
+        worker.start()
+        workers.append(worker)
+
+    results = collect_worker_results(result_queue, workers, len(workers))
+
+    results.sort(key=lambda x: x[0])
+    for rank, score, ids, history in results:
+        print(f"Restart {rank}: score {score:.4f}", resources["tokenizer"].convert_ids_to_tokens(ids[0]))
+    rank, score, ids, history = max(results, key=lambda x: x[1])
+    print(f"Global best from restart {rank}: score {score:.4f}", resources["tokenizer"].convert_ids_to_tokens(ids[0]))
+
+    return {
+        "best_adv_passage_ids": ids,
+        "best_score": score,
+        "best_adv_passage": resources["tokenizer"].convert_ids_to_tokens(ids[0]),
+        "restarts": results,
+    }
+
+
+def data_parallel_worker(rank, args, resources, root_dir, adv_passage_ids, checkpoint, port, result_queue):
+    """
+    Runs `optimize_trigger` as one of `args.data_parallel` gloo workers. All workers hold a retriever
+    replica and start from the same seed, so they draw the same batches and candidates; the gradient
+    pass is split over the batches and candidate scoring over the candidates, and the trigger-position
+    gradients and score vectors are all-reduced. Failures on any rank are reported to the parent
+    through `result_queue`.
+    """
+    try:
+        _data_parallel_worker(rank, args, resources, root_dir, adv_passage_ids, checkpoint, port, result_queue)
+    except BaseException:
+        result_queue.put(("error", rank, traceback.format_exc()))
+        raise
+
+
+def _data_parallel_worker(rank, args, resources, root_dir, adv_passage_ids, checkpoint, port, result_queue):
+    init_gloo(rank, args.data_parallel, port)
+    configure_cpu_threads(args.data_parallel, args.num_threads, args.num_interop_threads)
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    resources = worker_resources(resources)
+
+    worker_args = argparse.Namespace(**vars(args))
+    # only the first worker renders plots and writes checkpoints
+    worker_args.plot = args.plot and rank == 0
+    try:
+        result = optimize_trigger(worker_args, resources, root_dir, adv_passage_ids.clone(), checkpoint=checkpoint)
+    finally:
+        torch.distributed.destroy_process_group()
+    if rank == 0:
+        result_queue.put(("ok", result))
+
+
+def run_data_parallel(args, resources, root_dir, adv_passage_ids, checkpoint=None):
+    """
+    Forks `args.data_parallel` CPU workers that run one optimization together and returns its result.
+    """
+    assert resources["device"] == "cpu", "--data_parallel runs CPU workers"
+    if args.seed is None:
+        args.seed = random.randrange(2**31)
+
+    resources = dict(resources)
+    db_embeddings, _ = memmap_db_embeddings(resources["db_embeddings"], resources["db_dir"], args.model)
+    resources["db_embeddings"] = db_embeddings
+
+    ctx, resources = worker_context(resources)
+    port = find_free_port()
+    result_queue = ctx.Queue()
+
+    workers = []
+    for rank in range(args.data_parallel):
+        worker = ctx.Process(target=data_parallel_worker,
+                             args=(rank, args, resources, root_dir, adv_passage_ids, checkpoint, port, result_queue))
+        worker.start()
+        workers.append(worker)
+
+    # a failed rank leaves the others blocked in the all-reduce; they are terminated before re-raising
+    result, = collect_worker_results(result_queue, workers, 1)
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    checkpoint = None
+    if args.resume is not None:
+        resume_dir = f"{args.save_dir}/{args.agent}/{args.algo}" if args.resume == "latest" else args.resume
+        checkpoint_path = find_latest_checkpoint(resume_dir)
+        checkpoint = load_checkpoint(checkpoint_path)
+        restore_resume_args(parser, args, checkpoint.get("args", {}))
+        print(f"Resuming from {checkpoint_path} at iteration {checkpoint['iteration']}")
+
+    if args.report_to_wandb:
+
+        wandb.login()
+        wandb.init(project='agentpoison')
+        config = wandb.config
+        config.agent = args.agent
+        config.model = args.model
+        config.batch_size = args.per_gpu_eval_batch_size
+        config.num_iter = args.num_iter
+        config.num_grad_iter = args.num_grad_iter
+        config.num_cand = args.num_cand
+        config.num_adv_passage_tokens = args.num_adv_passage_tokens
+        config.target_gradient_guidance = args.target_gradient_guidance
+        config.use_gpt = args.use_gpt
+        config.golden_trigger = args.golden_trigger
+        config.asr_threshold = args.asr_threshold
+        config.ppl_filter = args.ppl_filter
+        config.algo = args.algo
+        config.lambda_weight = args.lambda_weight
+        config.multi_position = args.multi_position
+        config.successive_halving = args.successive_halving
+        config.score_cache_size = args.score_cache_size
+        config.tabu_size = args.tabu_size
+        config.surrogate = args.surrogate
+        config.beam_width = args.beam_width
+        config.beam_cands = args.beam_cands
+        config.data_parallel = args.data_parallel
+        config.bf16_scoring = args.bf16_scoring
+        config.export_retriever = args.export_retriever
+        config.quantized_scoring = args.quantized_scoring
+        config.memory_storage = args.memory_storage
+        config.pq_subspaces = args.pq_subspaces
+        config.rescore_top = args.rescore_top
+        config.agreement_every = args.agreement_every
+        config.adaptive_cand = args.adaptive_cand
+        config.early_stop_patience = args.early_stop_patience
+        config.plateau_tol = args.plateau_tol
+        config.vocab_filter = args.vocab_filter
+        config.knn_k = args.knn_k
+
+    assert args.resume is None or args.num_restarts == 1, "--resume is only supported for a single restart"
+    assert args.beam_width == 1 or (args.resume is None and args.num_restarts == 1 and not args.ppl_filter and not args.target_gradient_guidance), \
+        "--beam_width does not support --resume, --num_restarts, --ppl_filter or --target_gradient_guidance"
+    assert args.beam_width == 1 or (not args.checkpoint_every and not args.successive_halving and args.score_cache_size == 0 and args.tabu_size == 0
+                                    and args.knn_k == 0 and not args.surrogate and not args.adaptive_cand), \
+        "--beam_width does not support --checkpoint_every, --successive_halving, --score_cache_size, --tabu_size, --knn_k, --surrogate or --adaptive_cand"
+    assert args.data_parallel == 1 or (args.num_restarts == 1 and args.beam_width == 1 and not args.target_gradient_guidance), \
+        "--data_parallel does not support --num_restarts, --beam_width or --target_gradient_guidance"
+
+    if checkpoint is not None:
+        root_dir = os.path.dirname(checkpoint_path)
+    else:
+        root_dir = f"{args.save_dir}/{args.agent}/{args.algo}/{str(datetime.datetime.now())}"
+    os.makedirs(root_dir, exist_ok=True)
+
+    # Open a file and set stdout to it
+    # stdout_file = open(f"{root_dir}/stdout.txt", "w")
+    # sys.stdout = stdout_file
+
+    if args.seed is not None and args.num_restarts == 1:
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+    device = resolve_device(args.device)
+    target_device = device
+    if device == "cpu" and args.num_restarts == 1 and args.data_parallel == 1:
+        configure_cpu_threads(1, args.num_threads, args.num_interop_threads)
+    resources = load_resources(args, device, target_device)
+    if args.report_to_wandb and resources.get("memory_storage_report"):
+        try:
+            wandb.summary.update({f"Memory storage {name}": value for name, value in resources["memory_storage_report"].items()})
+        except Exception as e:
+            print(e)
+            pass
+    adv_passage_ids = init_adv_passage(args, resources["tokenizer"], device)
+
+    if args.num_restarts > 1:
+        result = run_parallel_restarts(args, resources, root_dir, adv_passage_ids)
+    elif args.data_parallel > 1:
+        result = run_data_parallel(args, resources, root_dir, adv_passage_ids, checkpoint=checkpoint)
+    elif args.beam_width > 1:
+        result = optimize_trigger_beam(args, resources, root_dir, adv_passage_ids)
+    else:
+        result = optimize_trigger(args, resources, root_dir, adv_passage_ids, checkpoint=checkpoint)
+    print('Best adv_passage', result["best_adv_passage"])
+    if result.get("stop_reason") is not None:
+        print('Stop reason', result["stop_reason"])
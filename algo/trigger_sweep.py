@@ -0,0 +1,134 @@
+import argparse
+import csv
+import datetime
+import itertools
+import os
+import random
+import sys
+import time
+import torch
+sys.path.append("./")
+from algo.utils import memmap_db_embeddings
+from algo.device_utils import resolve_device, configure_cpu_threads, worker_context, worker_resources
+from algo.trigger_optimization import (
+    build_arg_parser,
+    load_resources,
+    init_adv_passage,
+    optimize_trigger)
+
+# grid option -> trigger optimization argument
+SWEEP_GRID = {
+    "trigger_lengths": "num_adv_passage_tokens",
+    "num_cands": "num_cand",
+    "batch_sizes": "per_gpu_eval_batch_size",
+    "asr_thresholds": "asr_threshold",
+    "lambda_weights": "lambda_weight",
+}
+
+_worker_resources = None
+
+
+def _init_worker(resources, num_workers, num_threads, num_interop_threads):
+    global _worker_resources
+    resources = worker_resources(resources)
+    _worker_resources = resources
+    if resources["device"] == "cpu":
+        configure_cpu_threads(num_workers, num_threads, num_interop_threads)
+
+
+def run_config(job):
+    """
+    Runs one sweep configuration on the resources loaded by the pool initializer.
+    """
+    name, config_args, root_dir = job
+    if config_args.seed is not None:
+        random.seed(config_args.seed)
+        torch.manual_seed(config_args.seed)
+
+    os.makedirs(root_dir, exist_ok=True)
+    start_time = time.time()
+    adv_passage_ids = init_adv_passage(config_args, _worker_resources["tokenizer"], _worker_resources["device"])
+    result = optimize_trigger(config_args, _worker_resources, root_dir, adv_passage_ids)
+    history = result["history"]
+
+    row = {"config": name}
+    for arg_name in SWEEP_GRID.values():
+        row[arg_name] = getattr(config_args, arg_name)
+    row["final_score"] = history[-1]["loss"] if len(history) > 0 else None
+    row["best_score"] = result["best_score"]
+    row["num_improvements"] = sum(h["improved"] for h in history)
+    row["stop_reason"] = result.get("stop_reason")
+    row["time_sec"] = round(time.time() - start_time, 1)
+    row["best_adv_passage"] = " ".join(result["best_adv_passage"])
+    return row
+
+
+def build_jobs(args, sweep_dir):
+    grid_values = []
+    for grid_name, arg_name in SWEEP_GRID.items():
+        values = getattr(args, grid_name)
+        grid_values.append(values if values is not None else [getattr(args, arg_name)])
+
+    jobs = []
+    for values in itertools.product(*grid_values):
+        config_args = argparse.Namespace(**vars(args))
+        name_parts = []
+        for arg_name, value in zip(SWEEP_GRID.values(), values):
+            setattr(config_args, arg_name, value)
+            name_parts.append(f"{arg_name}_{value}")
+        name = "-".join(name_parts)
+        # workers never render plots or resume
+        config_args.plot = False
+        config_args.resume = None
+        jobs.append((name, config_args, f"{sweep_dir}/{name}"))
+    return jobs
+
+
+def write_results_table(rows, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    columns = [c for c in rows[0].keys() if c != "best_adv_passage"]
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in columns}
+    print(" | ".join(c.ljust(widths[c]) for c in columns))
+    print("-+-".join("-" * widths[c] for c in columns))
+    for r in rows:
+        print(" | ".join(str(r[c]).ljust(widths[c]) for c in columns))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(parents=[build_arg_parser()], conflict_handler="resolve")
+    parser.add_argument("--trigger_lengths", type=int, nargs="+", default=None, help="Grid of num_adv_passage_tokens values")
+    parser.add_argument("--num_cands", type=int, nargs="+", default=None, help="Grid of num_cand values")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=None, help="Grid of per_gpu_eval_batch_size values")
+    parser.add_argument("--asr_thresholds", type=float, nargs="+", default=None, help="Grid of asr_threshold values")
+    parser.add_argument("--lambda_weights", type=float, nargs="+", default=None, help="Grid of lambda_weight values")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of configurations run in parallel")
+    args = parser.parse_args()
+
+    sweep_dir = f"{args.save_dir}/{args.agent}/{args.algo}/sweep_{str(datetime.datetime.now())}"
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    device = resolve_device(args.device)
+    target_device = device
+    # loaded once and shared by every configuration
+    resources = load_resources(args, device, target_device)
+    resources["db_embeddings"], _ = memmap_db_embeddings(resources["db_embeddings"], resources["db_dir"], args.model)
+
+    jobs = build_jobs(args, sweep_dir)
+    print(f"Running {len(jobs)} configurations with {args.num_workers} workers")
+
+    if args.num_workers > 1:
+        ctx, resources = worker_context(resources)
+        with ctx.Pool(args.num_workers, initializer=_init_worker,
+                      initargs=(resources, args.num_workers, args.num_threads, args.num_interop_threads)) as pool:
+            rows = pool.map(run_config, jobs, chunksize=1)
+    else:
+        _init_worker(resources, 1, args.num_threads, args.num_interop_threads)
+        rows = [run_config(job) for job in jobs]
+
+    write_results_table(rows, f"{sweep_dir}/results.csv")
+    print(f"Results saved to {sweep_dir}/results.csv")
@@ -11,6 +11,7 @@ from transformers import (BertModel,
                           RealmEmbedder,
                           RealmForOpenQA)
 import torch
+import numpy as np
 import json, pickle, jsonlines
 from pathlib import Path
 from tqdm import tqdm
@@ -20,6 +21,8 @@ import requests
 import time
 
 from algo.config import model_code_to_embedder_name
+from algo.device_utils import resolve_device, model_device
+from algo.embedding_store import CompressedEmbeddings
 from agentdriver.llm_core.api_keys import OPENAI_API_KEY , OPENAI_BASE_URL 
 
 api_key = OPENAI_API_KEY
@@ -114,7 +117,9 @@ def target_asr(data, sample_size, target_word, CoT_prefix, trigger_sequence, dev
 
     return sample_ASR
 
-def target_word_prob(data, model, tokenizer, num_adv_passage_tokens, adv_passage_ids, adv_passage_attention, target_word, CoT_prefix, trigger_sequence, device='cuda'):
+def target_word_prob(data, model, tokenizer, num_adv_passage_tokens, adv_passage_ids, adv_passage_attention, target_word, CoT_prefix, trigger_sequence, device=None):
+    if device is None:
+        device = model_device(model)
 
     target_word_token = tokenizer(target_word, return_tensors="pt")["input_ids"].to(device)
 
@@ -134,14 +139,58 @@ def target_word_prob(data, model, tokenizer, num_adv_passage_tokens, adv_passage
 
 
 
-def bert_get_adv_emb(data, model, tokenizer, num_adv_passage_tokens, adv_passage_ids, adv_passage_attention, device='cuda'):
+def build_query_cache(data, tokenizer):
+    """
+    Tokenizes every `{ego} {perception} NOTICE:` query once, keyed by sample token, so that
+    bert_get_adv_emb does not re-run the tokenizer on every forward. The ids are kept untruncated;
+    truncation to the trigger length happens on lookup.
+    """
+    query_cache = {}
+    for token, ego, perception in zip(data["token"], data["ego"], data["perception"]):
+        query = f"{ego} {perception} NOTICE:"
+        query_cache[token] = tokenizer(query, truncation=False, return_tensors="pt")["input_ids"]
+    return query_cache
+
+
+def lookup_query_cache(query_cache, token, num_adv_passage_tokens):
+    """
+    Returns the cached query ids truncated like `tokenizer(..., truncation=True, max_length=512-num_adv_passage_tokens)`.
+    """
+    input_ids = query_cache[token]
+    max_length = 512 - num_adv_passage_tokens
+    if input_ids.shape[1] > max_length:
+        # keep the trailing [SEP]
+        input_ids = torch.cat((input_ids[:, :max_length - 1], input_ids[:, -1:]), dim=1)
+    return input_ids
+
+
+def materialize_batch(data, query_cache, num_adv_passage_tokens):
+    """
+    Attaches the truncated query ids of every sample in `data` under "input_ids", so that one batch can be
+    fed to the gradient pass and to candidate scoring without looking the queries up again.
+    """
+    data = dict(data)
+    data["input_ids"] = [lookup_query_cache(query_cache, token, num_adv_passage_tokens) for token in data["token"]]
+    return data
+
+
+def bert_get_adv_emb(data, model, tokenizer, num_adv_passage_tokens, adv_passage_ids, adv_passage_attention, device=None, query_cache=None):
+    if device is None:
+        device = model_device(model)
     query_embeddings = []
     if "ego" in data.keys():
-        for ego, perception in zip(data["ego"], data["perception"]):
-            query = f"{ego} {perception} NOTICE:"
+        for idx, (ego, perception) in enumerate(zip(data["ego"], data["perception"])):
+            if "input_ids" in data:
+                input_ids = data["input_ids"][idx]
+                tokenized_input = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+            elif query_cache is not None:
+                input_ids = lookup_query_cache(query_cache, data["token"][idx], num_adv_passage_tokens)
+                tokenized_input = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+            else:
+                query = f"{ego} {perception} NOTICE:"
 
-            # tokenized_input = tokenizer(query, padding='max_length', truncation=True, max_length=512, return_tensors="pt")
-            tokenized_input = tokenizer(query, truncation=True, max_length=512-num_adv_passage_tokens, return_tensors="pt")
+                # tokenized_input = tokenizer(query, padding='max_length', truncation=True, max_length=512, return_tensors="pt")
+                tokenized_input = tokenizer(query, truncation=True, max_length=512-num_adv_passage_tokens, return_tensors="pt")
             with torch.no_grad():
                 input_ids = tokenized_input["input_ids"].to(device)
 
@@ -199,6 +248,74 @@ def bert_get_adv_emb(data, model, tokenizer, num_adv_passage_tokens, adv_passage
     return query_embeddings
 
 
+def bert_get_adv_emb_stacked(data, model, num_adv_passage_tokens, passage_ids, device=None):
+    """
+    Differentiable embeddings of every query of a materialized batch followed by each of the (B, T)
+    triggers in `passage_ids`: every query is run once with its B triggers stacked as B rows of the
+    same length (no padding). Returns a (B, len(data), D) tensor.
+    """
+    if device is None:
+        device = model_device(model)
+    passage_ids = passage_ids.to(device)
+    num_passages = passage_ids.shape[0]
+    query_embeddings = []
+    for input_ids in data["input_ids"]:
+        input_ids = input_ids.to(device).expand(num_passages, -1)
+        suffix_adv_passage_ids = torch.cat((input_ids, passage_ids), dim=1)
+        p_sent = {'input_ids': suffix_adv_passage_ids, 'attention_mask': torch.ones_like(suffix_adv_passage_ids)}
+        query_embeddings.append(get_pooled_emb(model, p_sent))
+
+    return torch.stack(query_embeddings, dim=1)
+
+
+def bert_get_adv_emb_batched(data, model, num_adv_passage_tokens, candidate_passage_ids, query_cache, pad_token_id=0, device=None, batch_size=64):
+    """
+    Embeds every query of `data` followed by every candidate trigger in `candidate_passage_ids` (C, T).
+    The [query; trigger] sequences are right-padded and run through the retriever `batch_size` at a time,
+    grouped by length to keep padding small. Returns a (C, len(data), D) tensor.
+    """
+    if "input_ids" in data:
+        query_ids = [input_ids[0] for input_ids in data["input_ids"]]
+    else:
+        query_ids = [lookup_query_cache(query_cache, token, num_adv_passage_tokens)[0] for token in data["token"]]
+    if device is None:
+        device = model_device(model)
+    candidate_passage_ids = candidate_passage_ids.cpu()
+    num_candidates, num_queries = candidate_passage_ids.shape[0], len(query_ids)
+
+    # (candidate, query) pairs ordered by sequence length
+    order = sorted(range(num_candidates * num_queries), key=lambda i: len(query_ids[i % num_queries]))
+    query_embeddings = [None] * len(order)
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            chunk = order[start:start + batch_size]
+            max_length = max(len(query_ids[i % num_queries]) for i in chunk) + num_adv_passage_tokens
+            input_ids = torch.full((len(chunk), max_length), pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(chunk), max_length), dtype=torch.long)
+            for row, i in enumerate(chunk):
+                ids = query_ids[i % num_queries]
+                input_ids[row, :len(ids)] = ids
+                input_ids[row, len(ids):len(ids) + num_adv_passage_tokens] = candidate_passage_ids[i // num_queries]
+                attention_mask[row, :len(ids) + num_adv_passage_tokens] = 1
+            p_sent = {'input_ids': input_ids.to(device), 'attention_mask': attention_mask.to(device)}
+            p_emb = get_pooled_emb(model, p_sent)
+            for row, i in enumerate(chunk):
+                query_embeddings[i] = p_emb[row]
+
+    query_embeddings = torch.stack(query_embeddings, dim=0).view(num_candidates, num_queries, -1)
+
+    return query_embeddings
+
+
+def get_pooled_emb(model, p_sent):
+    if getattr(model, "returns_pooled_output", False):
+        # exported forward-only retriever (see algo/export_utils.py)
+        return model(**p_sent)
+    if isinstance(model, ClassificationNetwork) or isinstance(model, TripletNetwork):
+        return bert_get_emb(model, p_sent)
+    return model(**p_sent).pooler_output
+
+
 def bert_get_emb(model, input):
     return model.bert(**input).pooler_output
 
@@ -206,7 +323,8 @@ def ance_get_emb(model, input):
     input.pop('token_type_ids', None)
     return model(input)["sentence_embedding"]
 
-def load_models(model_code, device='cuda'):
+def load_models(model_code, device=None):
+    device = resolve_device(device)
     assert model_code in model_code_to_embedder_name, f"Model code {model_code} not supported!"
 
     if 'contrastive' in model_code:
@@ -268,7 +386,13 @@ def load_models(model_code, device='cuda'):
     
     return model, tokenizer, get_emb
 
-def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_train.json", db_dir="data/memory", model_code="None", model=None, tokenizer=None, device='cuda'):
+def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_train.json", db_dir="data/memory", model_code="None", model=None, tokenizer=None, device=None, encoder=None):
+    """
+    Loads (or encodes and caches) the memory database embeddings. `encoder` is an optional exported
+    forward-only retriever used instead of `model` for the encoding.
+    """
+    if device is None:
+        device = model_device(model) if model is not None else "cpu"
 
     
     if 'contrastive' in model_code:
@@ -289,7 +413,7 @@ def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_trai
                 with torch.no_grad():
                     input_ids = tokenized_input["input_ids"].to(device)
                     attention_mask = tokenized_input["attention_mask"].to(device)
-                    query_embedding = model(input_ids, attention_mask)
+                    query_embedding = encoder(input_ids, attention_mask) if encoder is not None else model(input_ids, attention_mask)
                     embeddings.append(query_embedding)
             try:
                 with open(f"{db_dir}/embeddings_{model_code}.pkl", "wb") as f:
@@ -322,7 +446,7 @@ def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_trai
                 with torch.no_grad():
                     input_ids = tokenized_input["input_ids"].to(device)
                     attention_mask = tokenized_input["attention_mask"].to(device)
-                    query_embedding = model(input_ids, attention_mask)
+                    query_embedding = encoder(input_ids, attention_mask) if encoder is not None else model(input_ids, attention_mask)
                     embeddings.append(query_embedding)
             try:
                 with open(f"{db_dir}/embeddings_{model_code}.pkl", "wb") as f:
@@ -355,7 +479,7 @@ def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_trai
                 with torch.no_grad():
                     input_ids = tokenized_input["input_ids"].to(device)
                     attention_mask = tokenized_input["attention_mask"].to(device)
-                    query_embedding = model(input_ids, attention_mask).pooler_output
+                    query_embedding = encoder(input_ids, attention_mask) if encoder is not None else model(input_ids, attention_mask).pooler_output
                     embeddings.append(query_embedding)
             try:
                 with open(f"{db_dir}/bert_embeddings.pkl", "wb") as f:
@@ -388,7 +512,7 @@ def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_trai
                 with torch.no_grad():
                     input_ids = tokenized_input["input_ids"].to(device)
                     attention_mask = tokenized_input["attention_mask"].to(device)
-                    query_embedding = model(input_ids, attention_mask).pooler_output
+                    query_embedding = encoder(input_ids, attention_mask) if encoder is not None else model(input_ids, attention_mask).pooler_output
                     query_embedding = query_embedding.detach().cpu().numpy().tolist()
                     embeddings.append(query_embedding)
             try:
@@ -422,7 +546,7 @@ def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_trai
                 with torch.no_grad():
                     input_ids = tokenized_input["input_ids"].to(device)
                     attention_mask = tokenized_input["attention_mask"].to(device)
-                    query_embedding = model(input_ids, attention_mask).pooler_output
+                    query_embedding = encoder(input_ids, attention_mask) if encoder is not None else model(input_ids, attention_mask).pooler_output
                     embeddings.append(query_embedding)
             try:
                 with open(f"{db_dir}/embeddings_{model_code}.pkl", "wb") as f:
@@ -455,7 +579,7 @@ def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_trai
                 with torch.no_grad():
                     input_ids = tokenized_input["input_ids"].to(device)
                     attention_mask = tokenized_input["attention_mask"].to(device)
-                    query_embedding = model(input_ids, attention_mask).pooler_output #.projected_score
+                    query_embedding = encoder(input_ids, attention_mask) if encoder is not None else model(input_ids, attention_mask).pooler_output #.projected_score
                     # print("query_embedding", query_embedding)
                     # input()
                     embeddings.append(query_embedding)
@@ -490,7 +614,7 @@ def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_trai
                 with torch.no_grad():
                     input_ids = tokenized_input["input_ids"].to(device)
                     attention_mask = tokenized_input["attention_mask"].to(device)
-                    query_embedding = model(input_ids, attention_mask).pooler_output
+                    query_embedding = encoder(input_ids, attention_mask) if encoder is not None else model(input_ids, attention_mask).pooler_output
                     # print("query_embedding", query_embedding)
                     # input()
                     embeddings.append(query_embedding)
@@ -512,6 +636,53 @@ def load_db_ad(database_samples_dir="agentdriver/data/finetune/data_samples_trai
     return db_embeddings
 
 
+def memmap_db_embeddings(db_embeddings, db_dir="data/memory", model_code="None"):
+    """
+    Stores the database embeddings once as a .npy file next to the pickle cache and returns a
+    memory-mapped view, so that worker processes share the same pages instead of holding copies.
+    Compressed memories are small enough to be moved to shared memory as they are.
+    """
+    if isinstance(db_embeddings, CompressedEmbeddings):
+        return db_embeddings.share_memory(), None
+    npy_path = f"{db_dir}/embeddings_{model_code}.npy"
+    if not Path(npy_path).exists():
+        np.save(npy_path, db_embeddings.detach().cpu().float().numpy())
+    # copy-on-write mapping: pages stay shared as long as nobody writes to them
+    db_embeddings = torch.from_numpy(np.load(npy_path, mmap_mode='c'))
+
+    return db_embeddings, npy_path
+
+
+def load_gmm_centers(db_embeddings, db_dir="data/memory", model_code="None", n_components=5, device='cpu', max_points=100000):
+    """
+    Fits a GaussianMixture on the database embeddings and caches its means under `db_dir`,
+    so that later runs (and resumed runs) skip the refit. Returns the cluster centers and the cache path.
+    Compressed memories are fitted on at most `max_points` decoded rows.
+    """
+    from sklearn.mixture import GaussianMixture
+
+    gmm_path = f"{db_dir}/gmm_{model_code}_{n_components}_{len(db_embeddings)}.pkl"
+    if isinstance(db_embeddings, CompressedEmbeddings):
+        gmm_path = f"{db_dir}/gmm_{model_code}_{n_components}_{len(db_embeddings)}_{db_embeddings.mode}.pkl"
+        db_embeddings = db_embeddings.sample(max_points)
+    if Path(gmm_path).exists():
+        with open(gmm_path, "rb") as f:
+            cluster_centers = pickle.load(f)
+    else:
+        gmm = GaussianMixture(n_components=n_components, covariance_type='full', random_state=0)
+        gmm.fit(db_embeddings.cpu().detach().numpy())
+        cluster_centers = gmm.means_
+        try:
+            with open(gmm_path, "wb") as f:
+                pickle.dump(cluster_centers, f)
+        except IOError as e:
+            print(f"Error saving gmm to file: {e}")
+
+    cluster_centers = torch.tensor(cluster_centers).to(device)
+
+    return cluster_centers, gmm_path
+
+
 
 
 ###### Utils for Perturbation ######
@@ -0,0 +1,130 @@
+import os
+import re
+import numpy as np
+import torch
+from pathlib import Path
+
+VOCAB_RULES = ["whole_words", "ascii", "no_special"]
+
+
+def _is_admissible(token, special_tokens, rules):
+    if "no_special" in rules and (token in special_tokens or re.fullmatch(r"\[unused\d+\]", token)):
+        return False
+    if "whole_words" in rules and token.startswith("##"):
+        return False
+    if "ascii" in rules and not token.isascii():
+        return False
+    # non-printable and whitespace-only tokens are never useful triggers
+    if not token.isprintable() or token.strip() == "":
+        return False
+    return True
+
+
+def build_admissible_token_ids(tokenizer, rules=VOCAB_RULES):
+    """
+    Returns the ids of the vocabulary tokens allowed as trigger candidates under `rules`.
+    """
+    special_tokens = set(tokenizer.all_special_tokens)
+    vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    admissible_ids = [i for i, token in enumerate(vocab) if _is_admissible(token, special_tokens, rules)]
+    return np.array(admissible_ids, dtype=np.int64)
+
+
+def vocab_rule_key(rules):
+    return "-".join(sorted(rules))
+
+
+def load_admissible_token_ids(tokenizer, cache_dir="data/memory", rules=VOCAB_RULES):
+    """
+    Loads the admissible token index of `tokenizer` from `cache_dir`, building and caching it on first use.
+    """
+    tokenizer_name = re.sub(r"[^\w\-.]", "_", tokenizer.name_or_path)
+    rule_key = vocab_rule_key(rules)
+    cache_path = f"{cache_dir}/admissible_{tokenizer_name}_{len(tokenizer)}_{rule_key}.npy"
+    if Path(cache_path).exists():
+        admissible_ids = np.load(cache_path)
+    else:
+        admissible_ids = build_admissible_token_ids(tokenizer, rules)
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_path, admissible_ids)
+
+    return torch.from_numpy(admissible_ids)
+
+
+def admissible_embedding_matrix(embedding_matrix, admissible_ids):
+    """
+    Gathers the admissible rows of the (frozen) word embedding matrix into one contiguous sub-matrix.
+    """
+    with torch.no_grad():
+        return embedding_matrix.index_select(0, admissible_ids.to(embedding_matrix.device)).contiguous()
+
+
+def build_knn_graph(embedding_matrix, k=32, admissible_ids=None, batch_size=1024):
+    """
+    Builds the cosine k-nearest-neighbour graph of the word embedding matrix. Every vocabulary token gets
+    a row; neighbours are restricted to `admissible_ids` when given. Returns an int32 (V, k) array of ids.
+    """
+    with torch.no_grad():
+        normed = torch.nn.functional.normalize(embedding_matrix.detach().float(), dim=1)
+        if admissible_ids is None:
+            admissible_ids = torch.arange(normed.shape[0], device=normed.device)
+        admissible_ids = admissible_ids.to(normed.device)
+        neighbour_matrix = normed.index_select(0, admissible_ids)
+
+        knn_graph = []
+        for start in range(0, normed.shape[0], batch_size):
+            rows = torch.arange(start, min(start + batch_size, normed.shape[0]), device=normed.device)
+            similarity = torch.matmul(normed[rows], neighbour_matrix.T)
+            # a token is not its own neighbour
+            similarity.masked_fill_(admissible_ids.unsqueeze(0) == rows.unsqueeze(1), float('-inf'))
+            _, top_k_ids = similarity.topk(k, dim=1)
+            knn_graph.append(admissible_ids[top_k_ids].cpu())
+
+    return torch.cat(knn_graph, dim=0).numpy().astype(np.int32)
+
+
+def load_knn_graph(embedding_matrix, cache_dir="data/memory", model_code="None", k=32, admissible_ids=None, rules=VOCAB_RULES):
+    """
+    Loads the word-embedding kNN graph of `model_code` from `cache_dir`, building and caching it on first use.
+    A graph restricted to `admissible_ids` is cached per set of vocabulary `rules`.
+    """
+    suffix = f"_admissible_{vocab_rule_key(rules)}" if admissible_ids is not None else ""
+    cache_path = f"{cache_dir}/knn_graph_{model_code}_{k}{suffix}.npy"
+    if Path(cache_path).exists():
+        knn_graph = np.load(cache_path)
+    else:
+        knn_graph = build_knn_graph(embedding_matrix, k, admissible_ids)
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_path, knn_graph)
+
+    return torch.from_numpy(knn_graph)
+
+
+def knn_candidates(knn_graph, averaged_grad, embedding_matrix, adv_passage_ids, positions, num_candidates, filter=None):
+    """
+    Proposes the graph neighbours of the current tokens at `positions`, re-ranked by the first-order
+    hotflip score, and keeps the best `num_candidates` (position, token) swaps.
+    Args:
+        knn_graph (Tensor): (V, k) int32 neighbour ids.
+        averaged_grad (Tensor): (T, D) gradient at every trigger position.
+        embedding_matrix (Tensor): (V, D) word embedding matrix.
+        adv_passage_ids (Tensor): (T,) current trigger ids.
+        positions (Tensor): Positions whose neighbourhoods are searched.
+        filter (Tensor): Optional (T, V) tensor subtracted from the ranking; swaps it sends to -inf are dropped.
+    Returns:
+        (Tensor, Tensor): Candidate token ids and the position each one replaces.
+    """
+    with torch.no_grad():
+        neighbours = knn_graph[adv_passage_ids[positions].cpu()].long().to(embedding_matrix.device)
+        scores = (embedding_matrix[neighbours] * averaged_grad[positions].unsqueeze(1)).sum(dim=2)
+        if filter is not None:
+            scores -= filter[positions.unsqueeze(1), neighbours]
+        # a graph over fewer than k + 1 admissible tokens lists the token itself as a (-inf) neighbour
+        scores.masked_fill_(neighbours == adv_passage_ids[positions].unsqueeze(1), float('-inf'))
+        top_scores, top_ids = scores.view(-1).topk(min(num_candidates, scores.numel()))
+        # a small neighbourhood would otherwise let filtered (tabu or inadmissible) swaps through
+        top_ids = top_ids[torch.isfinite(top_scores)]
+        candidate_positions = positions[top_ids // neighbours.shape[1]]
+        candidates = neighbours.view(-1)[top_ids]
+
+    return candidates, candidate_positions